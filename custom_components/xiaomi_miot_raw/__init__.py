@@ -19,6 +19,7 @@ from homeassistant.exceptions import PlatformNotReady, ConfigEntryNotReady
 from homeassistant.helpers import aiohttp_client, discovery
 from homeassistant.helpers.entity import Entity, ToggleEntity
 from homeassistant.helpers.entity_component import EntityComponent
+from homeassistant.helpers.event import async_track_time_interval
 from homeassistant.helpers.storage import Store
 from homeassistant.util import color
 from miio.exceptions import DeviceException
@@ -47,13 +48,16 @@ from .deps.const import (
 )
 
 from .deps.xiaomi_cloud_new import *
-from .deps.xiaomi_cloud_new import MiCloud
+from .deps.xiaomi_cloud_new import MiCloud, merge_devices
 from .deps.miot_coordinator import MiotCloudCoordinator
+from .deps.io_limiter import HostLimiter
+from .deps.device_list import DeviceListSync
 from asyncio.exceptions import CancelledError
 
 _LOGGER = logging.getLogger(__name__)
 
 SCAN_INTERVAL = timedelta(seconds=60)
+DEVICE_LIST_SYNC_INTERVAL = timedelta(hours=1)
 CONFIG_SCHEMA = vol.Schema(
     {
         DOMAIN: vol.Schema(
@@ -81,8 +85,28 @@ async def async_setup(hass, hassconfig):
     hass.data[DOMAIN].setdefault('configs', {})
     hass.data[DOMAIN].setdefault('miot_main_entity', {})
     hass.data[DOMAIN].setdefault('micloud_devices', [])
+    hass.data[DOMAIN].setdefault('micloud_device_lists', {})
     hass.data[DOMAIN].setdefault('cloud_instance_list', [])
     hass.data[DOMAIN].setdefault('event_fetcher_list', [])
+    hass.data[DOMAIN].setdefault('local_coordinators', {})
+    hass.data[DOMAIN].setdefault('local_io_limiter', HostLimiter())
+    if 'max_properties_store' not in hass.data[DOMAIN]:
+        store = Store(hass, 1, f"{DOMAIN}/max_properties.json")
+        hass.data[DOMAIN]['max_properties_store'] = store
+        hass.data[DOMAIN]['max_properties'] = await store.async_load() or {}
+    if 'miio_sessions_store' not in hass.data[DOMAIN]:
+        store = Store(hass, 1, f"{DOMAIN}/miio_sessions.json")
+        hass.data[DOMAIN]['miio_sessions_store'] = store
+        hass.data[DOMAIN]['miio_sessions'] = await store.async_load() or {}
+
+        async def save_sessions(event):
+            # last_seen 平时只是定期保存，关闭时再存一次
+            await hass.data[DOMAIN]['miio_sessions_store'].async_save(hass.data[DOMAIN]['miio_sessions'])
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, save_sessions)
+    if 'event_history_store' not in hass.data[DOMAIN]:
+        store = Store(hass, 1, f"{DOMAIN}/event_history.json")
+        hass.data[DOMAIN]['event_history_store'] = store
+        hass.data[DOMAIN]['event_history'] = await store.async_load() or {}
     hass.data[DOMAIN].setdefault('add_handler', {})
 
     component = EntityComponent(_LOGGER, DOMAIN, hass, SCAN_INTERVAL)
@@ -156,12 +180,11 @@ async def async_unload_entry(hass, entry):
     if 'username' in entry.data:
         # TODO
         try:
-            hass.data[DOMAIN]['micloud_devices'] = []
-            for item in hass.data[DOMAIN]['cloud_instance_list']:
-                if item['username'] == entry.data['username']:
-                    del item
-                    return True
-            return False
+            hass.data[DOMAIN]['micloud_device_lists'].pop(entry.entry_id, None)
+            _update_micloud_devices(hass)
+            # 云端实例仍被设备实体引用，不在此删除；重新加载时会复用它
+            return any(item['username'] == entry.data['username']
+                       for item in hass.data[DOMAIN]['cloud_instance_list'])
         except Exception as ex:
             _LOGGER.error(ex)
             return False
@@ -196,19 +219,43 @@ async def _setup_micloud_entry(hass, config_entry):
     """Thanks to @AlexxIT """
     data: dict = config_entry.data.copy()
     server_location = data.get('server_location') or 'cn'
-
-    session = aiohttp_client.async_create_clientsession(hass, auto_cleanup=False)
-    cloud = MiCloud(session)
+    # 设备分布在多个服务器时，可在配置项中以列表形式给出 servers
+    servers = data.get('servers') or [server_location]
+
+    # 重新加载（如修改限速）时复用已有实例，设备实体和 coordinator 仍持有它
+    existing = next((item for item in hass.data[DOMAIN]['cloud_instance_list']
+                     if item['username'] == data['username']), None)
+    if existing:
+        cloud = existing['cloud_instance']
+    else:
+        session = aiohttp_client.async_create_clientsession(hass, auto_cleanup=False)
+        cloud = MiCloud(session)
     cloud.svr = server_location
 
+    @callback
+    def save_auth(auth: dict):
+        hass.config_entries.async_update_entry(
+            config_entry, data={**config_entry.data, **auth})
+
+    cloud.set_credentials(data['username'], data['password'], save_auth)
+    cloud.rate_limiter.set_limits(data.get('rate_limits'))
+
+    # load devices from .storage first, sync with MiCloud afterwards
+    filename = sanitize_filename(data['username'])
+    device_list = DeviceListSync(
+        cloud, Store(hass, 1, f"{DOMAIN}/{filename}.json"), servers,
+        partial(_async_micloud_device_changed, hass)
+    )
+    await device_list.async_load(server_location)
+
+    synced = False
     if 'service_token' in data:
         # load devices with saved MiCloud auth
         cloud.auth = data
-        devices = await cloud.get_total_devices([server_location])
-    else:
-        devices = None
+        if not device_list.loaded:
+            synced = await device_list.async_sync()
 
-    if devices is None:
+    if 'service_token' not in data or not (synced or device_list.loaded):
         _LOGGER.debug(f"Login to MiCloud for {config_entry.title}")
         login_result = await cloud.login(data['username'], data['password'])
         if login_result == (0, None):
@@ -216,9 +263,7 @@ async def _setup_micloud_entry(hass, config_entry):
             data.update(cloud.auth)
             hass.config_entries.async_update_entry(config_entry, data=data)
 
-            devices = await cloud.get_total_devices([server_location])
-
-            if devices is None:
+            if not (synced := await device_list.async_sync()):
                 _LOGGER.error("Can't load devices from MiCloud")
         elif login_result[0] == -2:
             _LOGGER.error(f"Internal error occurred while logging in Xiaomi account: {login_result[1]}")
@@ -226,7 +271,7 @@ async def _setup_micloud_entry(hass, config_entry):
         else:
             _LOGGER.error("Can't login to MiCloud")
             raise ConfigEntryNotReady
-    if userid := cloud.auth.get('user_id'):
+    if not existing and (userid := cloud.auth.get('user_id')):
         # TODO don't allow login the same account twice
         hass.data[DOMAIN]['cloud_instance_list'].append({
             "user_id": userid,
@@ -235,28 +280,61 @@ async def _setup_micloud_entry(hass, config_entry):
             "coordinator": MiotCloudCoordinator(hass, cloud)
         })
 
-    # load devices from or save to .storage
-    filename = sanitize_filename(data['username'])
-    store = Store(hass, 1, f"{DOMAIN}/{filename}.json")
-    if devices is None:
-        _LOGGER.debug("Loading a list of devices from the .storage")
-        devices = await store.async_load()
-    else:
-        _LOGGER.debug(f"Loaded from MiCloud {len(devices)} devices")
-        await store.async_save(devices)
-
-    if devices is None:
+    if not device_list.loaded:
         _LOGGER.debug("No devices in .storage")
         return False
 
-    # TODO: Think about a bunch of devices
-    if 'micloud_devices' not in hass.data[DOMAIN]:
-        hass.data[DOMAIN]['micloud_devices'] = devices
-    else:
-        hass.data[DOMAIN]['micloud_devices'] += devices
+    hass.data[DOMAIN]['micloud_device_lists'][config_entry.entry_id] = device_list
+    _update_micloud_devices(hass)
+
+    async def sync(*_):
+        if await device_list.async_sync():
+            _update_micloud_devices(hass)
 
+    if not synced:
+        hass.async_create_task(sync())
+    config_entry.async_on_unload(
+        async_track_time_interval(hass, sync, DEVICE_LIST_SYNC_INTERVAL)
+    )
     return True
 
+@callback
+def _update_micloud_devices(hass):
+    hass.data[DOMAIN]['micloud_devices'] = merge_devices({
+        entry_id: device_list.devices
+        for entry_id, device_list in hass.data[DOMAIN]['micloud_device_lists'].items()
+    })
+
+@callback
+def _async_micloud_device_changed(hass, old: dict, new: dict):
+    """Follow a new IP or token of a device in the MiCloud device list,
+       without reloading the entries that use it."""
+    if not new.get('localip') or not new.get('token'):
+        return
+    if (old.get('localip'), old.get('token')) == (new['localip'], new['token']):
+        return
+    for entry in hass.config_entries.async_entries(DOMAIN):
+        dids = ((entry.data.get(CONF_CLOUD) or {}).get('did'),
+                (entry.data.get('cloud_device_info') or {}).get('did'))
+        if new['did'] not in dids:
+            continue
+        host, token = entry.data.get(CONF_HOST), entry.data.get(CONF_TOKEN)
+        if host == DUMMY_IP or (host, token) == (new['localip'], new['token']):
+            continue
+        _LOGGER.info(f"{entry.title} 的 IP 或 token 已变化：{host} -> {new['localip']}")
+        hass.config_entries.async_update_entry(
+            entry, data={**entry.data, CONF_HOST: new['localip'], CONF_TOKEN: new['token']})
+        if config := hass.data[DOMAIN]['configs'].get(entry.entry_id):
+            config[CONF_HOST] = new['localip']
+            config[CONF_TOKEN] = new['token']
+        for entity in hass.data[DOMAIN]['entities'].values():
+            device = getattr(entity, '_device', None)
+            if isinstance(device, MiotDevice) and (device.ip, device.token) == (host, token):
+                device.update_credentials(new['localip'], new['token'])
+        coordinators = hass.data[DOMAIN]['local_coordinators']
+        if co := coordinators.pop(f"{host}-{token}", None):
+            coordinators[f"{new['localip']}-{new['token']}"] = co
+
 def sanitize_filename(s: str):
     valid_chars = "-_.() abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
     filename = ''.join(c for c in s if c in valid_chars)
@@ -356,10 +434,16 @@ async def async_generic_setup_platform(
             miio_device = MiotDevice(ip=host, token=token, mapping=mapping)
         else:
             miio_device = MiotDevice(ip=host, token=token, mapping=mappingnew)
+        miio_device.set_session_cache(
+            hass.data[DOMAIN]['miio_sessions'],
+            partial(hass.data[DOMAIN]['miio_sessions_store'].async_delay_save,
+                    lambda: hass.data[DOMAIN]['miio_sessions'], 30)
+        )
+        miio_device.set_limiter(hass.data[DOMAIN]['local_io_limiter'])
         try:
             if host == DUMMY_IP and token == DUMMY_TOKEN:
                 raise DeviceException
-            device_info = miio_device.info()
+            device_info = await miio_device.async_info()
             model = device_info.model
             _LOGGER.info(
                 "%s %s %s detected",
@@ -370,6 +454,7 @@ async def async_generic_setup_platform(
         except DeviceException as de:
             if not config.get(CONF_CLOUD):
                 _LOGGER.warn(de)
+                miio_device.close()
                 raise ConfigEntryNotReady(de) from None
             else:
                 if not (di := config.get('cloud_device_info')):
@@ -383,6 +468,7 @@ async def async_generic_setup_platform(
                         "N/A for Cloud Mode"
                     )
         except OSError as oe:
+            miio_device.close()
             raise ConfigEntryNotReady(oe) from None
 
         if TYPE in ('sensor', 'binary_sensor'):
@@ -17,6 +17,7 @@ from homeassistant.exceptions import PlatformNotReady
 from homeassistant.helpers import aiohttp_client, discovery
 from homeassistant.helpers.entity import Entity, ToggleEntity
 from homeassistant.helpers.entity_component import EntityComponent
+from homeassistant.helpers.event import async_call_later
 from homeassistant.helpers.storage import Store
 from homeassistant.util import color
 from miio.exceptions import DeviceException
@@ -46,7 +47,10 @@ from .deps.const import (
 
 from .deps.xiaomi_cloud_new import *
 from .deps.xiaomi_cloud_new import MiCloud
-from .deps.miot_coordinator import MiotCloudCoordinator
+from .deps.miot_coordinator import MiotCloudCoordinator, MiotLocalCoordinator
+from .deps.state_cache import OptimisticCache, DEFAULT_OPTIMISTIC_TTL
+from .deps.miot_device_adapter import ACCESS_READ
+from .deps.poll_scheduler import POLL_TIER_NONE
 from asyncio.exceptions import CancelledError
 from . import (HAVE_NUMBER, HAVE_SELECT)
 
@@ -55,10 +59,12 @@ _LOGGER = logging.getLogger(__name__)
 
 SHORT_DELAY = 3
 LONG_DELAY = 5
+# 云端返回 code 1 后，回读确认写入的属性
+CONFIRM_RETRY_INTERVAL = 3
+CONFIRM_DEADLINE = 30
 NOTIFY_INTERVAL = 60 * 10
 
 OFFLINE_NOTIFY = False
-UPDATE_BETA_FLAG = False
 
 class GenericMiotDevice(Entity):
     """通用 MiOT 设备"""
@@ -89,6 +95,17 @@ class GenericMiotDevice(Entity):
                 })
                 return (mc, co)
 
+        def setup_local(self, hass) -> MiotLocalCoordinator:
+            key = f"{self._device.ip}-{self._device.token}"
+            co = hass.data[DOMAIN]['local_coordinators'].get(key)
+            if co is None:
+                co = MiotLocalCoordinator(hass, self._device, self._model,
+                                          self._max_properties, self._pipeline_window)
+                hass.data[DOMAIN]['local_coordinators'][key] = co
+            co.add_mapping(self._unique_id, self._mapping, self._max_properties,
+                           self._pipeline_window, self._poll_interval, self._poll_tiers)
+            return co
+
         self._device = device
         self._mi_type = mi_type
         self._did_prefix = f"{self._mi_type[:10]}_" if self._mi_type else ""
@@ -107,21 +124,50 @@ class GenericMiotDevice(Entity):
                     mappingnew[f"{k[:10]}_{kk}"] = vv
             self._mapping = mappingnew
 
+        self._keys_by_spiid = {}
+        for k, v in self._mapping.items():
+            if 'aiid' not in v and 'piid' in v:
+                self._keys_by_spiid.setdefault((v['siid'], v['piid']), []).append(k)
+
         self._ctrl_params = config.get(CONF_CONTROL_PARAMS) or {}
-        self._max_properties = 10
+        self._max_properties = None
+        self._pipeline_window = 1
+        self._poll_interval = None
+        self._confirm_delay = LONG_DELAY
+        self._optimistic_ttl = DEFAULT_OPTIMISTIC_TTL
+        self._write_batch_window = None
 
         if type(self._ctrl_params) == str:
             self._ctrl_params = json.loads(self._ctrl_params)
 
         if not type(self._ctrl_params) == OrderedDict:
             paramsnew = {}
-            self._max_properties = self._ctrl_params.pop('max_properties', 10)
+            # 这个 dict 由同一设备的所有实体共用，只读不改
+            self._max_properties = self._ctrl_params.get('max_properties')
+            self._pipeline_window = self._ctrl_params.get('pipeline_window', 1)
+            self._poll_interval = self._ctrl_params.get('poll_interval')
+            self._confirm_delay = self._ctrl_params.get('confirm_delay', LONG_DELAY)
+            self._optimistic_ttl = self._ctrl_params.get('optimistic_ttl', DEFAULT_OPTIMISTIC_TTL)
+            self._write_batch_window = self._ctrl_params.get('write_batch_window')
             for k,v in self._ctrl_params.items():
+                if not isinstance(v, dict):
+                    # 设备级的选项，不是某个服务的参数
+                    continue
                 for kk,vv in v.items():
                     paramsnew[f"{k[:10]}_{kk}"] = vv
             self._ctrl_params_new = paramsnew
         else:
             self._ctrl_params_new = self._ctrl_params
+        self._poll_tiers = {
+            k: v.get('poll_tier') or POLL_TIER_NONE for k, v in self._ctrl_params_new.items()
+            if isinstance(v, dict) and (
+                v.get('poll_tier') or ('access' in v and not v['access'] & ACCESS_READ))
+        }
+        # 单个属性可以用 optimistic_ttl 覆盖设备的值
+        self._optimistic_ttls = {
+            k: v['optimistic_ttl'] for k, v in self._ctrl_params_new.items()
+            if isinstance(v, dict) and v.get('optimistic_ttl') is not None
+        }
 
         if mi_type:
             self._ctrl_params = self._ctrl_params[mi_type]
@@ -129,7 +175,10 @@ class GenericMiotDevice(Entity):
         self._name = config.get(CONF_NAME)
         self._update_instant = config.get(CONF_UPDATE_INSTANT)
         self._skip_update = False
-        self._delay_update = 0
+        self._optimistic = OptimisticCache(self._optimistic_ttl)
+        self._pending_confirm = {}
+        self._confirm_deadline = None
+        self._unsub_confirm = None
 
         self._model = device_info.model
         self._unique_id = "{}-{}-{}".format(
@@ -150,20 +199,16 @@ class GenericMiotDevice(Entity):
         self._cloud_write = config.get('cloud_write')
         self._cloud_instance = None
         self.coordinator = None
-        self._body_for_update_cloud = None
+        self._coordinator_seen = False
+        self._coordinator_registered = False
         if self._cloud:
             c = setup_cloud(self, hass)
             self._cloud_instance = c[0]
             self.coordinator = c[1]
-            self.coordinator.add_fixed_by_mapping(self._cloud, self._mapping)
 
-            data1 = {}
-            data1['datasource'] = 1
-            data1['params'] = []
-            for value in self._mapping.values():
-                if 'aiid' not in value:
-                    data1['params'].append({**{'did':self._cloud.get("did")},**value})
-            self._body_for_update_cloud = json.dumps(data1,separators=(',', ':'))
+        self._local_coordinator = None
+        if not self._cloud and self._device is not None:
+            self._local_coordinator = setup_local(self, hass)
 
         self._fail_count = 0
         self._available = None
@@ -187,7 +232,7 @@ class GenericMiotDevice(Entity):
     @property
     def should_poll(self):
         """Poll the miio device."""
-        return True if (not UPDATE_BETA_FLAG or not self._cloud) else False
+        return not (self._local_coordinator or self.coordinator)
 
     @property
     def unique_id(self):
@@ -207,6 +252,11 @@ class GenericMiotDevice(Entity):
     @property
     def available(self):
         """Return true when state is known."""
+        if self._local_coordinator and self._local_coordinator.unreachable:
+            # 连续失败的次数由共享的 coordinator 统计，失败时不一定会通知实体
+            return False
+        if self.coordinator and not self.coordinator.device_available(self._cloud.get('did')):
+            return False
         return self._available
 
     @property
@@ -231,7 +281,7 @@ class GenericMiotDevice(Entity):
     async def _try_command(self, mask_error, func, *args, **kwargs):
         """Call a device command handling error messages."""
         try:
-            result = await self.hass.async_add_job(partial(func, *args, **kwargs))
+            result = await func(*args, **kwargs)
 
             _LOGGER.info("Response received from %s: %s", self._name, result)
             # This is a workaround. The action should not only return whether operation succeed, but also the 'out'.
@@ -243,28 +293,36 @@ class GenericMiotDevice(Entity):
             _LOGGER.error(mask_error, exc)
             return False
 
+    def _note_activity(self):
+        """Poll the device fast again after it was controlled."""
+        if self._local_coordinator:
+            self._local_coordinator.note_activity()
+        elif self.coordinator and self._cloud:
+            self.coordinator.note_activity(self._cloud.get("did"))
+
     async def set_property_new(self, field = "", params = "", multiparams:list = []):
+        self._note_activity()
         try:
             if not self._cloud_write:
                 if not multiparams:
                     result = await self._try_command(
                         f"Setting property for {self._name} failed.",
-                        self._device.set_property,
+                        self._device.async_set_property,
                         field,
                         params,
                     )
                     if result:
-                        if field in self._state_attrs:
-                            self._state_attrs[field] = params
+                        self._remember_written({field: params})
                         return True
                 else:
                     result = await self._try_command(
                         f"Setting property for {self._name} failed.",
-                        self._device.send,
+                        self._device.async_send,
                         "set_properties",
                         multiparams,
                     )
                     if result:
+                        self._remember_written(self._written_from(multiparams))
                         return True
                 return False
             else:
@@ -276,15 +334,14 @@ class GenericMiotDevice(Entity):
                         _LOGGER.error(f"Cannot control {self._name} by cloud because can't find {field} siid and piid from {self._mapping}")
                         return False
                     p = {**{'did': did, 'value': params},**spiid}
-                    p = {'params': [p]}
-                    pp = json.dumps(p,separators=(',', ':'))
-                    _LOGGER.info(f"Control {self._name} params: {pp}")
-                    results = await self._cloud_instance.set_props(pp, self._cloud.get("server_location"))
+                    _LOGGER.info(f"Control {self._name} params: {p}")
+                    results = await self._cloud_set_props([p])
                     if results:
                         if r := results.get('result'):
+                            confirm = {}
                             for item in r:
                                 if item['code'] == 1:
-                                    self._delay_update = LONG_DELAY
+                                    confirm[field] = params
                                 elif item['code'] == -704042011:
                                     if self._available == True or self._available == None:
                                         if OFFLINE_NOTIFY:
@@ -295,14 +352,13 @@ class GenericMiotDevice(Entity):
                                         else:
                                             _LOGGER.warn(f"请注意，云端接入设备 **{self._name}** 已离线。")
                                     self._available = False
-                                    self._skip_update = True
                                     return False
                                 elif item['code'] != 0:
                                     _LOGGER.error(f"Control {self._name} by cloud failed: {r}")
                                     return False
-                            if field in self._state_attrs:
-                                self._state_attrs[field] = params
-                            self._skip_update = True
+                            self._remember_written({field: params})
+                            if confirm:
+                                self._schedule_confirmation(confirm)
                             return True
                     return False
                 else:
@@ -310,15 +366,17 @@ class GenericMiotDevice(Entity):
                     p = multiparams
                     for item in p:
                         item['did'] = did
-                    pp = {'params': p}
-                    ppp = json.dumps(pp,separators=(',', ':'))
-                    _LOGGER.info(f"Control {self._name} params: {ppp}")
-                    results = await self._cloud_instance.set_props(ppp, self._cloud.get("server_location"))
+                    _LOGGER.info(f"Control {self._name} params: {p}")
+                    results = await self._cloud_set_props(p)
                     if results:
                         if r := results.get('result'):
+                            confirm = {}
                             for item in r:
                                 if item['code'] == 1:
-                                    self._delay_update = LONG_DELAY
+                                    value = next((x.get('value') for x in p if x.get('siid') == item.get('siid')
+                                                  and x.get('piid') == item.get('piid')), None)
+                                    for key in self._keys_for(item.get('siid'), item.get('piid')):
+                                        confirm[key] = value
                                 elif item['code'] == -704042011:
                                     if self._available == True or self._available == None:
                                         if OFFLINE_NOTIFY:
@@ -329,12 +387,13 @@ class GenericMiotDevice(Entity):
                                         else:
                                             _LOGGER.warn(f"请注意，云端接入设备 **{self._name}** 已离线。")
                                     self._available = False
-                                    self._skip_update = True
                                     return False
                                 elif item['code'] != 0:
                                     _LOGGER.error(f"Control {self._name} by cloud failed: {r}")
                                     return False
-                            self._skip_update = True
+                            self._remember_written(self._written_from(p))
+                            if confirm:
+                                self._schedule_confirmation(confirm)
                             return True
                     return False
 
@@ -356,11 +415,12 @@ class GenericMiotDevice(Entity):
             'in':   inn or [],
         }
 
+        self._note_activity()
         try:
             if not self._cloud_write:
                 result = await self._try_command(
                     f"Calling action for {self._name} failed.",
-                    self._device.send,
+                    self._device.async_send,
                     "action",
                     params,
                 )
@@ -379,147 +439,225 @@ class GenericMiotDevice(Entity):
             return False
 
     async def set_property_for_service(self, siid, piid, value):
+        self._note_activity()
         try:
             if not self._cloud_write:
                 result = await self._try_command(
                     f"Setting property for {self._name} failed.",
-                    self._device.send,
+                    self._device.async_send,
                     "set_properties",
                     [{"did": f"set-{siid}-{piid}", "siid": siid, "piid": piid, "value": value}],
                 )
             else:
                 did = self._cloud.get("did")
-                p = {'params': [{"did": did, "siid": siid, "piid": piid, "value": value}]}
-                pp = json.dumps(p,separators=(',', ':'))
-                results = await self._cloud_instance.set_props(pp, self._cloud.get("server_location"))
+                results = await self._cloud_set_props([{"did": did, "siid": siid, "piid": piid, "value": value}])
         except DeviceException as ex:
             _LOGGER.error('Set miot property to %s failed: %s', self._name, ex)
 
+    async def _cloud_set_props(self, params: list):
+        server = self._cloud.get("server_location")
+        if self._write_batch_window:
+            return await self._cloud_instance.set_props_batched(params, server, self._write_batch_window)
+        return await self._cloud_instance.set_props(json.dumps({'params': params}, separators=(',', ':')), server)
+
+    def _keys_for(self, siid, piid) -> list:
+        return self._keys_by_spiid.get((siid, piid), [])
+
+    def _written_from(self, multiparams) -> dict:
+        written = {}
+        for item in multiparams:
+            for key in self._keys_for(item.get('siid'), item.get('piid')):
+                written[key] = item.get('value')
+        return written
+
+    def _remember_written(self, written: dict):
+        """Show written values right away, and keep them over disagreeing
+           polls until the optimistic TTL runs out."""
+        for key, value in written.items():
+            value = self._pre_process_data(key, value)
+            self._optimistic.set(key, value, self._optimistic_ttls.get(key))
+            if key in self._state_attrs:
+                self._state_attrs[key] = value
+
+    async def _async_read_properties(self, keys) -> dict:
+        """Read only the given properties, returns {key: raw value}."""
+        props = [
+            {'did': key, 'siid': self._mapping[key]['siid'], 'piid': self._mapping[key]['piid']}
+            for key in keys if 'piid' in self._mapping.get(key, {})
+        ]
+        if not props:
+            return {}
+        if not self._cloud:
+            response = await self._device.async_get_properties(
+                props, property_getter="get_properties", max_properties=self._max_properties
+            )
+            return {item['did']: item.get('value') for item in response if item.get('code') == 0}
+
+        did = self._cloud.get("did")
+        body = json.dumps({
+            'datasource': 1,
+            'params': [{'did': did, 'siid': p['siid'], 'piid': p['piid']} for p in props]
+        }, separators=(',', ':'))
+        a = await self._cloud_instance.get_props(body, self._cloud.get("server_location"))
+        if not a or a.get('code') != 0:
+            return {}
+        values = {}
+        for item in a.get('result') or []:
+            if item.get('code') == 0:
+                for key in self._keys_for(item.get('siid'), item.get('piid')):
+                    values[key] = item.get('value')
+        return values
+
+    def _schedule_confirmation(self, written: dict):
+        """Read the written properties back after the device settled,
+           instead of delaying the next full update."""
+        self._pending_confirm.update(written)
+        if self._confirm_deadline is None:
+            self._confirm_deadline = time.monotonic() + CONFIRM_DEADLINE
+        self._schedule_confirm_read(self._confirm_delay)
+
+    def _schedule_confirm_read(self, delay):
+        if self._unsub_confirm:
+            self._unsub_confirm()
+        self._unsub_confirm = async_call_later(self._hass, delay, self._async_confirm_written)
+
+    async def _async_confirm_written(self, _now=None):
+        self._unsub_confirm = None
+        if not (pending := self._pending_confirm):
+            return
+        try:
+            values = await self._async_read_properties(list(pending))
+        except (DeviceException, OSError) as ex:
+            _LOGGER.debug("Confirming %s of %s failed: %s", list(pending), self._name, ex)
+            values = {}
+        statedict = {key: self._pre_process_data(key, value) for key, value in values.items()}
+        self._state_attrs.update(self._optimistic.apply(statedict))
+        for key, value in values.items():
+            if value == pending.get(key):
+                pending.pop(key, None)
+        if values:
+            self._handle_platform_specific_attrs()
+            self.publish_updates()
+            if self.hass:
+                self.async_write_ha_state()
+        if pending and time.monotonic() < self._confirm_deadline:
+            self._schedule_confirm_read(CONFIRM_RETRY_INTERVAL)
+            return
+        if pending:
+            _LOGGER.info("%s did not confirm %s in time", self._name, pending)
+        self._pending_confirm = {}
+        self._confirm_deadline = None
+
+    def _cancel_confirmation(self):
+        if self._unsub_confirm:
+            self._unsub_confirm()
+            self._unsub_confirm = None
+
+    def _pre_process_data(self, key, value):
+        if value is None:
+            return None
+        try:
+            if key in self._ctrl_params_new:
+                if f := self._ctrl_params_new[key].get('value_ratio'):
+                    return round(value * f , 3)
+                if 'value_list' in self._ctrl_params_new[key]:
+                    if s := self.get_key_by_value(self._ctrl_params_new[key]['value_list'], value):
+                        return s
+                elif (('status' in key and 'switch_status' not in key) \
+                    or 'state' in key \
+                    or 'fault' in key) \
+                    and type(value) == int:
+                    if s := self.get_key_by_value(self._ctrl_params_new[key], value):
+                        return s
+            return value
+        except KeyError:
+            return None
+
+    def _handle_local_response(self, response) -> dict:
+        """Convert a local get_properties response to state attributes."""
+        self._available = True
+
+        statedict={}
+        props_with_4004 = []
+        for r in response:
+            if r['code'] == 0:
+                statedict[r['did']] = self._pre_process_data(r['did'], r['value'])
+            elif r['code'] == 9999:
+                persistent_notification.async_create(
+                    self._hass,
+                    f"您添加的设备: **{self._name}** ，\n"
+                    f"在获取个状态时，\n"
+                    f"返回 **-9999** 错误。\n"
+                    "请考虑通过云端接入此设备来解决此问题。",
+                    "设备不支持本地接入")
+            else:
+                statedict[r['did']] = None
+                if r['code'] == -4004 and not self._err4004_notified:
+                    props_with_4004.append(r['did'])
+                else:
+                    _LOGGER.info("Error getting %s 's property '%s' (code: %s)", self._name, r['did'], r['code'])
+        if not self._err4004_notified:
+            if len(props_with_4004) == len(response):
+                self._assumed_state = True
+                self._skip_update = True
+                # _LOGGER.warn("设备不支持状态反馈")
+                if not self._err4004_notified:
+                    persistent_notification.async_create(
+                        self._hass,
+                        f"您添加的设备: **{self._name}** ，\n"
+                        f"在获取 {len(response)} 个状态时，\n"
+                        f"全部返回 **-4004** 错误。\n"
+                        "请考虑通过云端接入此设备来解决此问题。",
+                        "设备可能不受支持")
+                    self._err4004_notified = True
+                    del props_with_4004
+            elif len(props_with_4004) != 0:
+                _LOGGER.warn(f"Device {self._name} returns unknown error for property {props_with_4004}. If you encounter issues about this device, try enabling Cloud Access.")
+                self._err4004_notified = True
+                del props_with_4004
+        return statedict
+
+    def _handle_update_exception(self, ex):
+        if self._fail_count < 3:
+            self._fail_count += 1
+            _LOGGER.info("Got exception while fetching %s 's state: %s. Count %d", self._name, ex, self._fail_count)
+        else:
+            self._available = False
+            _LOGGER.error("Got exception while fetching %s 's state: %s", self._name, ex)
+
+    def _handle_local_coordinator_data(self):
+        """Apply the latest data of the shared local coordinator."""
+        if not self._local_coordinator.last_update_success:
+            # 是否可用见 available，不在这里按次数累计
+            return
+        if not (response := self._local_coordinator.get_response_for_mapping(self._mapping)):
+            return
+        statedict = self._handle_local_response(response)
+        self._fail_count = 0
+        self._state_attrs.update(self._optimistic.apply(statedict))
+        self._handle_platform_specific_attrs()
+        self.publish_updates()
+
     async def async_update(self):
         """Fetch state from the device."""
-        def pre_process_data(key, value):
-            if value is None:
-                return None
-            try:
-                if key in self._ctrl_params_new:
-                    if f := self._ctrl_params_new[key].get('value_ratio'):
-                        return round(value * f , 3)
-                    if 'value_list' in self._ctrl_params_new[key]:
-                        if s := self.get_key_by_value(self._ctrl_params_new[key]['value_list'], value):
-                            return s
-                    elif (('status' in key and 'switch_status' not in key) \
-                        or 'state' in key \
-                        or 'fault' in key) \
-                        and type(value) == int:
-                        if s := self.get_key_by_value(self._ctrl_params_new[key], value):
-                            return s
-                return value
-            except KeyError:
-                return None
-
         # On state change some devices doesn't provide the new state immediately.
         if self._update_instant is False or self._skip_update:
             self._skip_update = False
-            self._delay_update = 0
             return
-        if self._delay_update != 0:
-            await asyncio.sleep(self._delay_update)
-            self._delay_update = 0
         try:
             if not self._cloud:
-                response = await self.hass.async_add_job(
-                    partial(self._device.get_properties_for_mapping, max_properties=self._max_properties)
-                )
-                self._available = True
-
-                statedict={}
-                props_with_4004 = []
-                for r in response:
-                    if r['code'] == 0:
-                        statedict[r['did']] = pre_process_data(r['did'], r['value'])
-                    elif r['code'] == 9999:
-                        persistent_notification.async_create(
-                            self._hass,
-                            f"您添加的设备: **{self._name}** ，\n"
-                            f"在获取个状态时，\n"
-                            f"返回 **-9999** 错误。\n"
-                            "请考虑通过云端接入此设备来解决此问题。",
-                            "设备不支持本地接入")
-                    else:
-                        statedict[r['did']] = None
-                        if r['code'] == -4004 and not self._err4004_notified:
-                            props_with_4004.append(r['did'])
-                        else:
-                            _LOGGER.info("Error getting %s 's property '%s' (code: %s)", self._name, r['did'], r['code'])
-                if not self._err4004_notified:
-                    if len(props_with_4004) == len(response):
-                        self._assumed_state = True
-                        self._skip_update = True
-                        # _LOGGER.warn("设备不支持状态反馈")
-                        if not self._err4004_notified:
-                            persistent_notification.async_create(
-                                self._hass,
-                                f"您添加的设备: **{self._name}** ，\n"
-                                f"在获取 {len(response)} 个状态时，\n"
-                                f"全部返回 **-4004** 错误。\n"
-                                "请考虑通过云端接入此设备来解决此问题。",
-                                "设备可能不受支持")
-                            self._err4004_notified = True
-                            del props_with_4004
-                    elif len(props_with_4004) != 0:
-                        _LOGGER.warn(f"Device {self._name} returns unknown error for property {props_with_4004}. If you encounter issues about this device, try enabling Cloud Access.")
-                        self._err4004_notified = True
-                        del props_with_4004
-
+                await self._local_coordinator.async_request_refresh()
+                self._handle_local_coordinator_data()
+                return
             else:
-                _LOGGER.info(f"{self._name} is updating from cloud.")
-
-                a = await self._cloud_instance.get_props(self._body_for_update_cloud, self._cloud.get("server_location"))
-
-                dict1 = {}
-                statedict = {}
-                if a:
-                    if a['code'] != 0:
-                        _LOGGER.error(f"Error updating {self._name} from cloud: {a}")
-                        return None
-                    if all(item['code'] == -704042011 for item in a['result']):
-                        if self._available == True or self._available == None:
-                            if OFFLINE_NOTIFY:
-                                persistent_notification.async_create(
-                                    self._hass,
-                                    f"请注意，云端接入设备 **{self._name}** 已离线。",
-                                    "Xiaomi MIoT - 设备离线")
-                            else:
-                                _LOGGER.warn(f"请注意，云端接入设备 **{self._name}** 已离线。")
-                        self._available = False
-                    else:
-                        self._available = True
-
-                    for item in a['result']:
-                        # TODO handle -704030013 (Unreadable property)
-                        dict1.setdefault(item['siid'], {})
-                        dict1[item['siid']][item['piid']] = item.get('value')
-
-                    for key, value in self._mapping.items():
-                        if 'aiid' in value:
-                            continue
-                        statedict[key] = pre_process_data(key, dict1[value['siid']][value['piid']])
-
-                else:
-                    pass
-
-            self._fail_count = 0
-            self._state_attrs.update(statedict)
-            self._handle_platform_specific_attrs()
-            self.publish_updates()
-
+                # 云端设备由账号的 coordinator 统一批量读取
+                if not self._coordinator_registered:
+                    # 还没加入 hass，属性还没注册，注册后会读一次
+                    return
+                await self.coordinator.async_request_refresh()
+                self._handle_coordinator_data()
         except (DeviceException, OSError) as ex:
-            if self._fail_count < 3:
-                self._fail_count += 1
-                _LOGGER.info("Got exception while fetching %s 's state: %s. Count %d", self._name, ex, self._fail_count)
-            else:
-                self._available = False
-                _LOGGER.error("Got exception while fetching %s 's state: %s", self._name, ex)
+            self._handle_update_exception(ex)
 
     async def create_sub_entities(self):
         """这里应该用_ctrl_params_new，因为已经包含所有子设备，所以运行一次附加到主设备即可，不重不漏
@@ -635,48 +773,113 @@ class GenericMiotDevice(Entity):
 
     async def async_added_to_hass(self) -> None:
         """When entity is added to hass."""
-        if UPDATE_BETA_FLAG and self.coordinator:
+        if self.coordinator:
+            self.async_on_remove(
+                self.coordinator.register_mapping(self._cloud, self._mapping,
+                                                  self._poll_interval, self._poll_tiers)
+            )
+            self._coordinator_registered = True
             self.async_on_remove(
                 self.coordinator.async_add_listener(self._handle_coordinator_update)
             )
+            # 刚注册的属性尽快读一次，同时启动的实体会被合并到一次请求里
+            self.hass.async_create_task(self.coordinator.async_request_refresh())
+        self.async_on_remove(self._cancel_confirmation)
+        if self._device is not None:
+            self.async_on_remove(self._device.close)
+        if self._local_coordinator:
+            if self.platform and self.platform.scan_interval:
+                self._local_coordinator.set_scan_interval(
+                    self._unique_id, self.platform.scan_interval.total_seconds())
+            self.async_on_remove(
+                self._local_coordinator.async_add_listener(self._handle_local_coordinator_update)
+            )
+            self.async_on_remove(self._release_local_coordinator)
+
+    @callback
+    def _release_local_coordinator(self) -> None:
+        """Drop the shared coordinator with its last entity, so a reload or
+           a new IP/token sets up a fresh one."""
+        co = self._local_coordinator
+        co.remove_mapping(self._unique_id)
+        if co.in_use:
+            return
+        coordinators = self.hass.data[DOMAIN]['local_coordinators']
+        for key in [k for k, v in coordinators.items() if v is co]:
+            del coordinators[key]
+        co.close()
+
+    @callback
+    def _handle_local_coordinator_update(self) -> None:
+        """Handle updated data from the local coordinator."""
+        if self._update_instant is False or self._skip_update:
+            self._skip_update = False
+            return
+        self._handle_local_coordinator_data()
+        self.async_write_ha_state()
 
     @callback
     def _handle_coordinator_update(self) -> None:
-        """Handle updated data from the coordinator."""
-        dict1 = {}
-        statedict = {}
-        if self._cloud['did'] in self.coordinator.data:
-            if all(item['code'] == -704042011 for item in self.coordinator.data[self._cloud['did']]):
-                if self._available == True or self._available == None:
-                    if OFFLINE_NOTIFY:
-                        persistent_notification.async_create(
-                            self._hass,
-                            f"请注意，云端接入设备 **{self._name}** 已离线。",
-                            "Xiaomi MIoT - 设备离线")
-                    else:
-                        _LOGGER.warn(f"请注意，云端接入设备 **{self._name}** 已离线。")
-                self._available = False
-            else:
-                self._available = True
-            for item in self.coordinator.data[self._cloud['did']]:
-                if dict1.get(item['siid']):
-                    dict1[item['siid']][item['piid']] = item.get('value')
+        """Handle updated data from the cloud coordinator."""
+        if self._update_instant is False or self._skip_update:
+            self._skip_update = False
+            return
+        if self._handle_coordinator_data():
+            self.async_write_ha_state()
+
+    def _handle_coordinator_data(self) -> bool:
+        """Apply this device's part of the latest cloud coordinator data.
+           Only properties that changed are looked at, returns False when
+           there was nothing to do for this entity."""
+        if not self.coordinator.last_update_success:
+            # 是否可用由 coordinator 按设备统计，见 available
+            return True
+        data = self.coordinator.data
+        did = self._cloud['did']
+        if did in data.failed:
+            return True
+        if self._coordinator_seen and did not in data.answered:
+            return False
+
+        was_available = self._available
+        if did in data.offline:
+            if self._available == True or self._available == None:
+                if OFFLINE_NOTIFY:
+                    persistent_notification.async_create(
+                        self._hass,
+                        f"请注意，云端接入设备 **{self._name}** 已离线。",
+                        "Xiaomi MIoT - 设备离线")
                 else:
-                    dict1[item['siid']] = {}
-                    dict1[item['siid']][item['piid']] = item.get('value')
-
-            for key, value in self._mapping.items():
-                try:
-                    statedict[key] = dict1[value['siid']][value['piid']]
-                except KeyError:
-                    statedict[key] = None
+                    _LOGGER.warn(f"请注意，云端接入设备 **{self._name}** 已离线。")
+            self._available = False
+        elif did in data.answered:
+            self._available = True
+
+        if self._coordinator_seen:
+            # Written values are checked again until their TTL is over.
+            spiids = set(data.changed.get(did, ())) | {
+                (self._mapping[k]['siid'], self._mapping[k]['piid'])
+                for k in self._optimistic.keys() if 'piid' in self._mapping.get(k, {})
+            }
         else:
-            pass
+            spiids = self._keys_by_spiid.keys()
+        statedict = {}
+        for spiid in spiids:
+            # TODO handle -704030013 (Unreadable property)
+            if (prop := data.index.get((did, *spiid))) is None:
+                continue
+            for key in self._keys_by_spiid.get(spiid, ()):
+                statedict[key] = self._pre_process_data(key, prop.value)
+        if statedict:
+            self._coordinator_seen = True
 
-        self._state_attrs.update(statedict)
+        self._fail_count = 0
+        if not statedict:
+            return self._available != was_available
+        self._state_attrs.update(self._optimistic.apply(statedict))
         self._handle_platform_specific_attrs()
-        self.async_write_ha_state()
         self.publish_updates()
+        return True
 
     def _handle_platform_specific_attrs(self):
         pass
@@ -839,7 +1042,6 @@ class MiotSubToggleableDevice(MiotSubDevice):
             self._state = True
             self._state_attrs[f"{self._did_prefix}switch_status"] = True
             self._parent_device.schedule_update_ha_state(force_refresh=True)
-            self._skip_update = True
 
     async def async_turn_off(self, **kwargs):
         """Turn off."""
@@ -849,7 +1051,6 @@ class MiotSubToggleableDevice(MiotSubDevice):
             self._state = False
             self._state_attrs[f"{self._did_prefix}switch_status"] = False
             self._parent_device.schedule_update_ha_state(force_refresh=True)
-            self._skip_update = True
 
     @property
     def is_on(self):
@@ -925,7 +1126,6 @@ class MiotIRDevice(GenericMiotDevice):
             c = setup_cloud(self, hass)
             self._cloud_instance = c[0]
             self.coordinator = c[1]
-            self.coordinator.add_fixed_by_mapping(self._cloud, self._mapping)
 
             data1 = {}
             data1['datasource'] = 1
@@ -935,6 +1135,13 @@ class MiotIRDevice(GenericMiotDevice):
                     data1['params'].append({**{'did':self._cloud.get("did")},**value})
             self._body_for_update_cloud = json.dumps(data1,separators=(',', ':'))
 
+        self._local_coordinator = None
+        self._optimistic = OptimisticCache()
+        self._optimistic_ttls = {}
+        self._write_batch_window = None
+        self._pending_confirm = {}
+        self._confirm_deadline = None
+        self._unsub_confirm = None
         self._state = None
         self._state_attrs = {}
         self._available = True
@@ -949,6 +1156,9 @@ class MiotIRDevice(GenericMiotDevice):
         """Poll the IR device."""
         return False
 
+    async def async_added_to_hass(self) -> None:
+        """IR devices have no state to follow."""
+
     @property
     def device_info(self):
         return {
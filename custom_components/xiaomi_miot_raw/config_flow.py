@@ -39,6 +39,7 @@ from .deps.const import (
 from .deps.miot_device_adapter import MiotAdapter
 from .deps.special_devices import SPECIAL_DEVICES
 from .deps.xiaomi_cloud_new import MiCloud
+from .deps.rate_limiter import DEFAULT_RATE_LIMITS, DEFAULT_TOTAL_RATE_LIMIT
 
 SERVERS = {
     'cn': "China",
@@ -523,8 +524,8 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
     async def async_step_xiaomi_account(self, user_input=None, error=None, hint=""): # 登录小米账号
         if user_input:
             if 'username' in user_input:
-                # if not user_input['servers']:
-                    # return await self.async_step_xiaomi_account(error='no_servers')
+                # 未勾选设备所在服务器时，只同步登录服务器上的设备
+                user_input['servers'] = user_input.get('servers') or [user_input['server_location']]
 
                 session = aiohttp_client.async_create_clientsession(self.hass)
                 cloud = MiCloud(session)
@@ -535,7 +536,7 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
                     self._all_config = user_input
                     if not self._non_interactive:
                         self.hass.async_add_job(self.hass.config_entries.flow.async_init(
-                            DOMAIN, context={"source": "user"}, data={'action': 'xiaomi_account', 'username': user_input['username'],'password': user_input['password'],'server_location': user_input['server_location']}
+                            DOMAIN, context={"source": "user"}, data={'action': 'xiaomi_account', 'username': user_input['username'],'password': user_input['password'],'server_location': user_input['server_location'],'servers': user_input['servers']}
                         ))
                         return await self.async_step_select_devices()
                     else:
@@ -556,7 +557,7 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
                 vol.Required('username', default=self._all_config.get('username')): str,
                 vol.Required('password'): str,
                 vol.Required('server_location', default=self._all_config.get('server_location') or 'cn'): vol.In(SERVERS),
-                    # cv.multi_select(SERVERS)
+                vol.Optional('servers', default=self._all_config.get('servers') or [self._all_config.get('server_location') or 'cn']): cv.multi_select(SERVERS),
             }),
             description_placeholders={"hint": hint},
             errors={'base': error}
@@ -675,6 +676,8 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
                 self._steps.append(self.async_step_update_xiaomi_account())
             if user_input.get('async_step_select_devices', False):
                 self._steps.append(self.async_step_select_devices())
+            if user_input.get('async_step_cloud_rate_limit', False):
+                self._steps.append(self.async_step_cloud_rate_limit())
             if user_input.get('async_step_light_and_lock', False):
                 self._steps.append(self.async_step_light_and_lock())
             if user_input.get('async_step_climate', False):
@@ -700,6 +703,7 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
         if 'password' in self._all_config:
             fields[vol.Optional("async_step_update_xiaomi_account")] = bool
             fields[vol.Optional("async_step_select_devices")] = bool
+            fields[vol.Optional("async_step_cloud_rate_limit")] = bool
         else:
             fields[vol.Optional("async_step_re_adapt")] = bool
             fields[vol.Optional("async_step_edit_mpprm")] = bool
@@ -733,6 +737,7 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
                 resp = await cloud.login(user_input['username'],
                                     user_input['password'])
                 if resp == (0, None):
+                    user_input['servers'] = user_input.get('servers') or [user_input['server_location']]
                     self._all_config.update(user_input)
                     self._all_config.update(cloud.auth)
                     self._steps.pop(0)
@@ -751,13 +756,38 @@ class OptionsFlowHandler(config_entries.OptionsFlow):
                 # vol.Required('username', default=self._all_config.get('username')): str,
                 vol.Required('password'): str,
                 vol.Required('server_location', default=self._all_config.get('server_location') or 'cn'): vol.In(SERVERS),
-                    # cv.multi_select(SERVERS)
+                vol.Optional('servers', default=self._all_config.get('servers') or [self._all_config.get('server_location') or 'cn']): cv.multi_select(SERVERS),
             }),
             description_placeholders={"hint": hint, "username": self._all_config.get('username')},
             errors={'base': error}
         )
 
 
+    async def async_step_cloud_rate_limit(self, user_input=None):
+        errors = {}
+        if user_input is not None:
+            limits = {
+                k.replace('_rate_limit', ''): v for k, v in user_input.items()
+            }
+            if limits['total'] < max(v for k, v in limits.items() if k != 'total'):
+                errors['base'] = 'total_rate_limit_too_low'
+            else:
+                self._all_config['rate_limits'] = limits
+                self._steps.pop(0)
+                return await self._steps[0]
+        else:
+            limits = {**DEFAULT_RATE_LIMITS, 'total': DEFAULT_TOTAL_RATE_LIMIT,
+                      **(self._all_config.get('rate_limits') or {})}
+        rate = vol.All(vol.Coerce(float), vol.Range(min=0.1))
+        return self.async_show_form(
+            step_id='cloud_rate_limit',
+            data_schema=vol.Schema({
+                vol.Required(f'{k}_rate_limit', default=limits[k]): rate
+                for k in ('read', 'write', 'history', 'total')
+            }),
+            errors=errors,
+        )
+
     async def async_step_light_and_lock(self, user_input=None):
         if user_input is not None:
             if 'show_indicator_light' in user_input:
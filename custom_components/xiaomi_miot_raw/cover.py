@@ -58,6 +58,7 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
 )
 
 SCAN_INTERVAL = timedelta(seconds=2)
+MOVING_POLL_INTERVAL = 1
 # pylint: disable=unused-argument
 
 @asyncio.coroutine
@@ -92,8 +93,18 @@ class MiotCover(GenericMiotDevice, CoverEntity):
 
     @property
     def should_poll(self):
-        """The cover should always be pulled."""
-        return True
+        """The cover should always be pulled. With a coordinator it is
+           polled by that, at the cover's scan interval or faster."""
+        return not (self._local_coordinator or self.coordinator)
+
+    def _set_moving(self, moving: bool):
+        """Poll fast while the cover moves, every second if it is local."""
+        self.async_update = self._throttle1 if moving else self._throttle10
+        if self._local_coordinator:
+            self._local_coordinator.hold_interval(
+                self._unique_id, MOVING_POLL_INTERVAL if moving else None)
+        elif moving and self.coordinator:
+            self.coordinator.note_activity(self._cloud.get("did"))
 
     @property
     def available(self):
@@ -160,7 +171,7 @@ class MiotCover(GenericMiotDevice, CoverEntity):
             except KeyError as ex:
                 pass
             self.async_write_ha_state()
-            self.async_update = self._throttle1
+            self._set_moving(True)
             self.schedule_update_ha_state(force_refresh=True)
 
     async def async_close_cover(self, **kwargs):
@@ -172,7 +183,7 @@ class MiotCover(GenericMiotDevice, CoverEntity):
             except KeyError:
                 pass
             self.async_write_ha_state()
-            self.async_update = self._throttle1
+            self._set_moving(True)
             self.schedule_update_ha_state(force_refresh=True)
 
     async def async_stop_cover(self, **kwargs):
@@ -189,7 +200,7 @@ class MiotCover(GenericMiotDevice, CoverEntity):
             result = await self.set_property_new(self._did_prefix + "target_position",kwargs['position'])
 
         if result:
-            self._skip_update = True
+            self.async_write_ha_state()
 
     def _handle_platform_specific_attrs(self):
         super()._handle_platform_specific_attrs()
@@ -197,10 +208,7 @@ class MiotCover(GenericMiotDevice, CoverEntity):
         if 'current_position' in self._ctrl_params:
             if 'value_range' in self._ctrl_params['current_position'] and self._current_position is not None:
                 self._current_position = self.convert_value(self._current_position,"current_position",False,self._ctrl_params['current_position']['value_range'])
-        if self.is_closing or self.is_opening:
-            self.async_update = self._throttle1
-        else:
-            self.async_update = self._throttle10
+        self._set_moving(self.is_closing or self.is_opening)
         self._action = self._state_attrs.get(self._did_prefix + 'motor_status') or \
             self._state_attrs.get(self._did_prefix + 'status')
 
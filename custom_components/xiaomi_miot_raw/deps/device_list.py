@@ -0,0 +1,79 @@
+import hashlib
+import json
+import logging
+
+from .xiaomi_cloud_new import MiCloud, merge_devices
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def record_hash(device: dict) -> str:
+    return hashlib.md5(json.dumps(device, sort_keys=True).encode()).hexdigest()
+
+
+class DeviceListSync:
+    """Device list of one account, kept per server in its .storage file.
+
+    It is loaded from the .storage first, so setup does not wait for the
+    cloud. `async_sync` fetches the lists again and only touches records
+    whose hash changed. `on_change(old, new)` is called for each of them.
+    """
+
+    def __init__(self, cloud: MiCloud, store, servers: list, on_change=None):
+        self._cloud = cloud
+        self._store = store
+        self._servers = servers
+        self._on_change = on_change
+        self._regions = {}
+        self._hashes = {}
+
+    @property
+    def devices(self) -> list:
+        return merge_devices({s: self._regions.get(s) for s in self._servers})
+
+    @property
+    def loaded(self) -> bool:
+        return any(self._regions.get(s) is not None for s in self._servers)
+
+    async def async_load(self, default_server: str):
+        cached = await self._store.async_load()
+        if isinstance(cached, list):
+            # 旧格式，只保存了一个服务器的设备列表
+            cached = {default_server: cached}
+        self._regions = cached or {}
+        self._hashes = {
+            d.get('did'): record_hash(d) for devices in self._regions.values() for d in devices or []
+        }
+
+    async def async_sync(self, *_) -> bool:
+        """Returns True if at least one server answered."""
+        by_region = await self._cloud.get_devices_by_region(self._servers)
+        fresh = {s: devices for s, devices in by_region.items() if devices is not None}
+        if not fresh:
+            return False
+        if failed := [s for s in self._servers if s not in fresh and s in self._regions]:
+            _LOGGER.warning(f"Using the device list of {', '.join(failed)} from the .storage")
+
+        old = {d.get('did'): d for d in self.devices}
+        changed = []
+        for devices in fresh.values():
+            for device in devices:
+                did = device.get('did')
+                h = record_hash(device)
+                if self._hashes.get(did) != h:
+                    self._hashes[did] = h
+                    changed.append((old.get(did), device))
+        removed = {d.get('did') for s in fresh for d in self._regions.get(s) or []} - \
+            {d.get('did') for devices in fresh.values() for d in devices}
+        for did in removed:
+            self._hashes.pop(did, None)
+
+        self._regions.update(fresh)
+        if changed or removed:
+            _LOGGER.debug(f"MiCloud device list: {len(changed)} changed, {len(removed)} removed")
+            await self._store.async_save(self._regions)
+        if self._on_change:
+            for old_device, device in changed:
+                if old_device is not None:
+                    self._on_change(old_device, device)
+        return True
@@ -0,0 +1,44 @@
+from collections import deque
+
+DEFAULT_EVENT_HISTORY_SIZE = 50
+
+
+class EventHistory:
+    """The last `capacity` events of a sensor, newest first.
+
+    An event is a (time, value) pair and is only stored once, however
+    often later fetches return it again. Once the buffer is full, events
+    older than everything in it are dropped instead of coming back.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_EVENT_HISTORY_SIZE, events: list = None):
+        self._events = deque(maxlen=capacity)
+        self._seen = set()
+        if events:
+            self.extend(events)
+
+    def __len__(self):
+        return len(self._events)
+
+    def extend(self, events: list) -> list:
+        """Add events in any order, returns the ones that were new."""
+        new = []
+        for event in sorted((tuple(e) for e in events), key=lambda e: e[0]):
+            if event in self._seen:
+                continue
+            if len(self._events) == self._events.maxlen and event[0] < self._events[-1][0]:
+                continue
+            new.append(event)
+            self._seen.add(event)
+            if len(self._events) == self._events.maxlen:
+                self._seen.discard(self._events.pop())
+            # newest first, an older late event is put at its place
+            i = 0
+            while i < len(self._events) and self._events[i][0] > event[0]:
+                i += 1
+            self._events.insert(i, event)
+        return new
+
+    def latest(self, n: int = None) -> list:
+        """The last n events, newest first."""
+        return list(self._events)[:n]
@@ -0,0 +1,107 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+DEFAULT_LOCAL_IO_LIMIT = 16
+DEFAULT_LOCAL_IO_PER_HOST = 4
+
+
+class HostLimiter:
+    """Global limit on concurrent device requests, fair between hosts.
+
+    Each host has its own FIFO queue and may hold at most `per_host` slots.
+    Free slots are handed out round robin over the waiting hosts, so an
+    offline host waiting for its timeouts only blocks its own requests.
+    """
+
+    def __init__(self, limit: int = DEFAULT_LOCAL_IO_LIMIT,
+                 per_host: int = DEFAULT_LOCAL_IO_PER_HOST):
+        self.limit = limit
+        self.per_host = per_host
+        self._active = 0
+        self._active_by_host = {}
+        self._queues = OrderedDict()
+        self.max_queue_depth = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.limit,
+            'per_host': self.per_host,
+            'active': self._active,
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'avg_wait': round(self.wait_time / self.waits, 3) if self.waits else 0,
+        }
+
+    def _has_slot(self, host) -> bool:
+        return self._active < self.limit and \
+            self._active_by_host.get(host, 0) < self.per_host
+
+    def _take(self, host):
+        self._active += 1
+        self._active_by_host[host] = self._active_by_host.get(host, 0) + 1
+
+    def _release(self, host):
+        self._active -= 1
+        if (n := self._active_by_host[host] - 1) > 0:
+            self._active_by_host[host] = n
+        else:
+            del self._active_by_host[host]
+        self._wake()
+
+    def _wake(self):
+        progress = True
+        while progress and self._queues and self._active < self.limit:
+            progress = False
+            for host in list(self._queues):
+                q = self._queues[host]
+                while q and q[0].cancelled():
+                    q.popleft()
+                if not q:
+                    del self._queues[host]
+                    continue
+                if not self._has_slot(host):
+                    continue
+                self._take(host)
+                q.popleft().set_result(None)
+                if q:
+                    self._queues.move_to_end(host)
+                else:
+                    del self._queues[host]
+                progress = True
+                if self._active >= self.limit:
+                    return
+
+    @asynccontextmanager
+    async def acquire(self, host):
+        if host not in self._queues and self._has_slot(host):
+            self._take(host)
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            self._queues.setdefault(host, deque()).append(fut)
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            start = time.monotonic()
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    # The slot was granted right before the cancellation.
+                    self._release(host)
+                raise
+            self.waits += 1
+            self.wait_time += time.monotonic() - start
+        try:
+            yield
+        finally:
+            self._release(host)
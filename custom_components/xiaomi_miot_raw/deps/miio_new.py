@@ -1,4 +1,281 @@
+import asyncio
+import calendar
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+
+import construct
+from miio.device import DeviceInfo
+from miio.exceptions import DeviceError, DeviceException, RecoverableError
 from miio.miot_device import MiotDevice as MiotDeviceOriginal
+from miio.protocol import Message
+
+_LOGGER = logging.getLogger(__name__)
+
+MIIO_PORT = 54321
+HELLO = bytes.fromhex(
+    "21310020ffffffffffffffffffffffffffffffffffffffffffffffffffffffff"
+)
+# A cached session older than this is not trusted, a new hello is sent.
+SESSION_MAX_AGE = 86400
+# Seconds the device stamp may differ from the estimate before a new hello is sent.
+SESSION_MAX_DRIFT = 10
+# last_seen is written to the cache file at most this often.
+SESSION_SAVE_INTERVAL = 3600
+
+
+class MiioDatagramProtocol(asyncio.DatagramProtocol):
+    """Hands every datagram of one device over to its transport."""
+
+    def __init__(self, transport):
+        self._miio = transport
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self._miio.datagram_received(data)
+
+    def error_received(self, exc):
+        self._miio.error_received(exc)
+
+    def connection_lost(self, exc):
+        self._miio.connection_lost(self.transport, exc)
+
+
+class AsyncMiioTransport:
+    """miIO protocol on top of asyncio, without an executor thread.
+
+    Requests are sent over a single connected UDP endpoint and the replies
+    are matched to the waiting request by the message id.
+
+    Device id and stamp offset from the last handshake are kept in
+    `sessions`, keyed by host. A transport that finds its host there skips
+    the hello packet, `on_session_change` is called to persist the cache.
+    """
+
+    def __init__(self, ip: str, token: str, timeout: int = 5, port: int = MIIO_PORT,
+                 sessions: dict = None, on_session_change = None):
+        self.ip = ip
+        self.port = port
+        self.token = bytes.fromhex(token if token is not None else 32 * "0")
+        self._timeout = timeout
+        self._id = random.randint(1, 9000)
+        self._transport = None
+        self._lock = asyncio.Lock()
+        self._hello = None
+        self._pending = {}
+        self._device_id = None
+        self._device_ts = None
+        self._device_ts_received = 0
+        self._sessions = sessions if sessions is not None else {}
+        self._on_session_change = on_session_change
+        self._session_saved = 0
+        self._restore_session()
+
+    def _restore_session(self):
+        s = self._sessions.get(self.ip)
+        if not s or time.time() - s.get('last_seen', 0) > SESSION_MAX_AGE:
+            return
+        self._device_id = bytes.fromhex(s['device_id'])
+        self._device_ts = datetime.utcfromtimestamp(time.time() + s['ts_offset'])
+        self._device_ts_received = time.monotonic()
+        _LOGGER.debug("Reusing session of %s, device id %s", self.ip, self._device_id)
+
+    def _save_session(self, force: bool = False):
+        offset = calendar.timegm(self._device_ts.timetuple()) - time.time()
+        device_id = self._device_id.hex()
+        s = self._sessions.get(self.ip)
+        now = time.time()
+        if force or not s or s['device_id'] != device_id:
+            self._sessions[self.ip] = {
+                'device_id': device_id,
+                'ts_offset': round(offset),
+                'last_seen': now,
+            }
+        else:
+            s['last_seen'] = now
+            if now - self._session_saved < SESSION_SAVE_INTERVAL:
+                return
+        # Otherwise the saved last_seen is the last handshake and the cache expires after a day.
+        self._session_saved = now
+        if self._on_session_change is not None:
+            self._on_session_change()
+
+    def _drop_session(self):
+        self._device_id = None
+        if self._sessions.pop(self.ip, None) is not None and self._on_session_change is not None:
+            self._on_session_change()
+
+    @property
+    def discovered(self) -> bool:
+        return self._device_id is not None
+
+    def _next_id(self) -> int:
+        self._id += 1
+        if self._id >= 9999:
+            self._id = 1
+        return self._id
+
+    async def _ensure_endpoint(self):
+        if self._transport is None or self._transport.is_closing():
+            loop = asyncio.get_running_loop()
+            self._transport, _ = await loop.create_datagram_endpoint(
+                lambda: MiioDatagramProtocol(self),
+                remote_addr=(self.ip, self.port),
+            )
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    async def send_handshake(self, retry_count: int = 3):
+        """Send a hello packet and remember device id and timestamp."""
+        async with self._lock:
+            if self.discovered:
+                # Another request finished the handshake meanwhile.
+                return None
+            await self._ensure_endpoint()
+            for _ in range(retry_count + 1):
+                self._hello = asyncio.get_running_loop().create_future()
+                self._transport.sendto(HELLO)
+                try:
+                    m = await asyncio.wait_for(self._hello, self._timeout)
+                except asyncio.TimeoutError:
+                    continue
+                finally:
+                    self._hello = None
+                header = m.header.value
+                self._device_id = header.device_id
+                self._device_ts = header.ts
+                self._device_ts_received = time.monotonic()
+                _LOGGER.debug("Discovered %s with ts: %s", self.ip, self._device_ts)
+                self._save_session(force=True)
+                return m
+            _LOGGER.debug("Unable to discover a device at address %s", self.ip)
+            raise DeviceException(f"Unable to discover the device {self.ip}")
+
+    def datagram_received(self, data: bytes):
+        if len(data) == 32:
+            # Hello reply, only a header.
+            if self._hello is not None and not self._hello.done():
+                try:
+                    self._hello.set_result(Message.parse(data))
+                except construct.ConstructError as ex:
+                    _LOGGER.debug("Malformed hello reply from %s: %s", self.ip, ex)
+            return
+        try:
+            m = Message.parse(data, token=self.token)
+        except construct.core.ChecksumError:
+            # Maybe not the device we cached, say hello again next time.
+            self._drop_session()
+            self._fail_pending(DeviceException(
+                "Got checksum error which indicates use "
+                "of an invalid token. "
+                "Please check your token!"
+            ))
+            return
+        except construct.ConstructError as ex:
+            _LOGGER.debug("Malformed reply from %s: %s", self.ip, ex)
+            return
+
+        payload = m.data.value
+        if not isinstance(payload, dict):
+            _LOGGER.debug("Unable to decode reply from %s: %s", self.ip, payload)
+            return
+        fut = self._pending.pop(payload.get("id"), None)
+        if fut is None or fut.done():
+            _LOGGER.debug("Dropping late reply from %s: %s", self.ip, payload)
+            return
+        ts = m.header.value.ts
+        expected = self._device_ts + timedelta(seconds=time.monotonic() - self._device_ts_received)
+        if abs((ts - expected).total_seconds()) > SESSION_MAX_DRIFT:
+            # The cached stamp is off, say hello again before the next request.
+            _LOGGER.debug("Stamp of %s drifted to %s, expected %s", self.ip, ts, expected)
+            self._drop_session()
+        else:
+            self._device_ts = ts
+            self._device_ts_received = time.monotonic()
+            self._save_session()
+        fut.set_result(payload)
+
+    def error_received(self, exc):
+        # e.g. ICMP unreachable. Not fatal for UDP, the endpoint stays open and is reused.
+        _LOGGER.debug("Error from %s: %s", self.ip, exc)
+        self._fail_pending(DeviceException(exc))
+
+    def connection_lost(self, transport, exc):
+        if exc is not None:
+            _LOGGER.debug("Connection to %s failed: %s", self.ip, exc)
+            self._fail_pending(DeviceException(exc))
+        # A late loss of an endpoint that was already replaced is ignored.
+        if transport is self._transport:
+            self._transport = None
+
+    def _fail_pending(self, exc):
+        pending, self._pending = self._pending, {}
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception(exc)
+
+    def _build(self, request: dict) -> bytes:
+        elapsed = int(time.monotonic() - self._device_ts_received)
+        header = {
+            "length": 0,
+            "unknown": 0x00000000,
+            "device_id": self._device_id,
+            "ts": self._device_ts + timedelta(seconds=elapsed + 1),
+        }
+        msg = {"data": {"value": request}, "header": {"value": header}, "checksum": 0}
+        return Message.build(msg, token=self.token)
+
+    async def send(self, command: str, parameters=None, retry_count: int = 3):
+        """Send a command and wait for the reply with the same id."""
+        if not self.discovered:
+            await self.send_handshake()
+        await self._ensure_endpoint()
+
+        request_id = self._next_id()
+        request = {
+            "id": request_id,
+            "method": command,
+            "params": parameters if parameters is not None else [],
+        }
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = fut
+        _LOGGER.debug("%s:%s >>: %s", self.ip, self.port, request)
+        try:
+            self._transport.sendto(self._build(request))
+            payload = await asyncio.wait_for(fut, self._timeout)
+        except asyncio.TimeoutError as ex:
+            self._pending.pop(request_id, None)
+            if retry_count > 0:
+                _LOGGER.debug("Retrying %s with new handshake, retries left: %s", self.ip, retry_count)
+                self._id += 100
+                self._drop_session()
+                return await self.send(command, parameters, retry_count - 1)
+            _LOGGER.error("Got error when receiving from %s: %s", self.ip, ex)
+            raise DeviceException("No response from the device") from ex
+        finally:
+            self._pending.pop(request_id, None)
+
+        _LOGGER.debug("%s:%s << %s", self.ip, self.port, payload)
+        if "error" in payload:
+            error = payload["error"]
+            if isinstance(error, dict) and error.get("code") == -30001:
+                if retry_count > 0:
+                    return await self.send(command, parameters, retry_count - 1)
+                raise DeviceException("Unable to recover failed command") from RecoverableError(error)
+            raise DeviceError(error)
+
+        try:
+            return payload["result"]
+        except KeyError:
+            return payload
+
 
 class MiotDevice(MiotDeviceOriginal):
     def __init__(
@@ -17,6 +294,45 @@ class MiotDevice(MiotDeviceOriginal):
             super().__init__(ip=ip, token=str(token), start_id=start_id,
                             debug=debug, lazy_discover=lazy_discover)
             self.mapping = mapping
+        self._async_transport = None
+        self._sessions = None
+        self._on_session_change = None
+        self._limiter = None
+
+    def set_limiter(self, limiter):
+        """Requests wait for a slot of this shared HostLimiter."""
+        self._limiter = limiter
+
+    def set_session_cache(self, sessions: dict, on_change = None):
+        """Share handshake results between devices and across restarts."""
+        self._sessions = sessions
+        self._on_session_change = on_change
+
+    def update_credentials(self, ip: str, token: str):
+        """Talk to the device at a new IP or with a new token from now on."""
+        if self._async_transport is not None:
+            self._async_transport._drop_session()
+            self._async_transport.close()
+            self._async_transport = None
+        self.ip = ip
+        self.token = token
+        self._protocol.ip = ip
+        self._protocol.token = bytes.fromhex(token)
+        self._protocol._discovered = False
+
+    def close(self):
+        """Close the UDP endpoint. The next request opens a new one."""
+        if self._async_transport is not None:
+            self._async_transport.close()
+
+    @property
+    def async_transport(self) -> AsyncMiioTransport:
+        if self._async_transport is None:
+            self._async_transport = AsyncMiioTransport(
+                self.ip, self.token, getattr(self._protocol, '_timeout', 5),
+                sessions=self._sessions, on_session_change=self._on_session_change
+            )
+        return self._async_transport
 
     def get_properties_for_mapping(self, max_properties=10) -> list:
         """Retrieve raw properties based on mapping."""
@@ -29,3 +345,47 @@ class MiotDevice(MiotDeviceOriginal):
         return self.get_properties(
             properties, property_getter="get_properties", max_properties=max_properties
         )
+
+    async def async_send(self, command: str, parameters=None, retry_count: int = 3):
+        if self._limiter is None:
+            return await self.async_transport.send(command, parameters, retry_count)
+        async with self._limiter.acquire(self.ip):
+            return await self.async_transport.send(command, parameters, retry_count)
+
+    async def async_info(self) -> DeviceInfo:
+        return DeviceInfo(await self.async_send("miIO.info"))
+
+    async def async_get_properties(self, properties, *, property_getter="get_properties",
+                                   max_properties=None, pipeline_window=1) -> list:
+        """Same as get_properties, but runs on the event loop.
+
+        With a pipeline_window above 1, up to that many chunks are sent
+        without waiting for the previous reply. Replies are matched by id,
+        so the values keep the order of the requested properties.
+        """
+        if max_properties is None:
+            return list(await self.async_send(property_getter, properties))
+        chunks = [
+            properties[i:i + max_properties] for i in range(0, len(properties), max_properties)
+        ]
+        values = []
+        if pipeline_window <= 1:
+            for chunk in chunks:
+                values.extend(await self.async_send(property_getter, chunk))
+            return values
+
+        window = asyncio.Semaphore(pipeline_window)
+
+        async def read_chunk(chunk):
+            async with window:
+                return await self.async_send(property_getter, chunk)
+
+        for result in await asyncio.gather(*[read_chunk(chunk) for chunk in chunks]):
+            values.extend(result)
+        return values
+
+    async def async_set_property(self, property_key: str, value):
+        return await self.async_send(
+            "set_properties",
+            [{"did": property_key, **self.mapping[property_key], "value": value}],
+        )
@@ -1,6 +1,7 @@
 import asyncio
 import json
 import logging
+import time
 from datetime import timedelta, datetime
 from functools import partial
 from dataclasses import dataclass
@@ -17,13 +18,15 @@ from homeassistant.helpers import aiohttp_client, discovery
 from homeassistant.helpers.entity import Entity, ToggleEntity
 from homeassistant.helpers.entity_component import EntityComponent
 from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed
+from homeassistant.helpers.debounce import Debouncer
 from homeassistant.helpers.storage import Store
 from homeassistant.util import color
-from miio.exceptions import DeviceException
+from miio.exceptions import DeviceError, DeviceException
 from .miio_new import MiotDevice
 import copy
 import math
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from types import MappingProxyType
 
 from .const import (
     DOMAIN,
@@ -41,11 +44,106 @@ from .const import (
 
 from .xiaomi_cloud_new import *
 from .xiaomi_cloud_new import MiCloud
+from .poll_scheduler import (
+    AdaptiveInterval,
+    CircuitBreaker,
+    DeviceSchedule,
+    TierClock,
+    phase_of,
+    phased_delay,
+    DEFAULT_CLOUD_POLL_INTERVAL,
+    DEFAULT_LOCAL_POLL_INTERVAL,
+    POLL_TIER_FAST,
+    POLL_TIER_NORMAL,
+    POLL_TIER_SLOW,
+    POLL_TIER_NONE,
+)
 from asyncio.exceptions import CancelledError
 
 _LOGGER = logging.getLogger(__name__)
 
-class MiotCloudCoordinator(DataUpdateCoordinator):
+TIER_ORDER = (POLL_TIER_FAST, POLL_TIER_NORMAL, POLL_TIER_SLOW, POLL_TIER_NONE)
+
+def faster_tier(a, b):
+    return a if TIER_ORDER.index(a) <= TIER_ORDER.index(b) else b
+
+DEFAULT_MAX_PROPERTIES = 10
+MAX_PROPERTIES_PROBE_LIMIT = 20
+# A size without reply is tried this many times before it counts as too large
+MAX_PROPERTIES_PROBE_ATTEMPTS = 2
+# Probed limits are checked again after this many seconds
+MAX_PROPERTIES_PROBE_TTL = 7 * 86400
+
+# 事件轮询：每轮间隔，首次读取的记录数，增量读取时每次最多的记录数
+EVENT_POLL_INTERVAL = 6
+EVENT_HISTORY = 5
+EVENT_FETCH_LIMIT = 20
+
+# 云端批量读取，每个请求的上限与并发数
+CLOUD_BATCH_MAX_PROPERTIES = 100
+CLOUD_BATCH_MAX_BYTES = 8192
+CLOUD_BATCH_CONCURRENCY = 4
+# 云端设备连续这么多轮读取失败后才算不可用
+CLOUD_FAIL_TOLERANCE = 3
+
+def split_batches(params: list, max_properties: int = CLOUD_BATCH_MAX_PROPERTIES,
+                  max_bytes: int = CLOUD_BATCH_MAX_BYTES) -> list:
+    """Split params into request bodies capped by item count and size."""
+    batches = []
+    batch, size = [], 0
+    for p in params:
+        n = len(json.dumps(p, separators=(',', ':'))) + 1
+        if batch and (len(batch) >= max_properties or size + n > max_bytes):
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(p)
+        size += n
+    if batch:
+        batches.append(batch)
+    return batches
+
+class PhasedCoordinator(DataUpdateCoordinator):
+    """Refreshes at a fixed phase within the interval, so coordinators set
+       up at the same moment do not all poll at the start of it."""
+    _phase = 0
+
+    @callback
+    def _schedule_refresh(self) -> None:
+        interval = self.update_interval
+        if interval is None:
+            return super()._schedule_refresh()
+        seconds = interval.total_seconds()
+        self.update_interval = timedelta(seconds=phased_delay(self._phase, seconds))
+        try:
+            super()._schedule_refresh()
+        finally:
+            self.update_interval = interval
+
+@dataclass(frozen=True)
+class CloudProperty:
+    code: int
+    value: object
+    timestamp: float
+
+@dataclass(frozen=True)
+class CloudSnapshot:
+    """What the cloud coordinator publishes after a round.
+
+    `index` maps (did, siid, piid) to the latest CloudProperty of every
+    registered property. `changed` maps a did to the (siid, piid) keys whose
+    code or value changed in this round, `answered` and `offline` are the
+    dids that were answered in this round and the ones reported offline,
+    `failed` the ones whose request failed.
+    """
+    index: MappingProxyType
+    changed: MappingProxyType
+    answered: frozenset
+    offline: frozenset
+    failed: frozenset = frozenset()
+
+EMPTY_SNAPSHOT = CloudSnapshot(MappingProxyType({}), MappingProxyType({}), frozenset(), frozenset())
+
+class MiotCloudCoordinator(PhasedCoordinator):
     """Manages polling for state changes from the device.
        One for each account."""
 
@@ -56,75 +154,514 @@ class MiotCloudCoordinator(DataUpdateCoordinator):
             hass,
             _LOGGER,
             name=f"{DOMAIN}-{cloud.auth['user_id']}",
-            update_interval=timedelta(seconds=6),
+            update_interval=timedelta(seconds=DEFAULT_CLOUD_POLL_INTERVAL[0]),
         )
+        self._phase = phase_of(cloud.auth['user_id'])
         self._cloud_instance = cloud
         self._error_count = 0
-        self._fixed_list = []
-        self._waiting_list = [] # 请求的params
-        self._results = {}
+        # (did, siid, piid) -> Counter of the poll tiers it was registered with
+        self._registry = {}
+        # Every did has its own adaptive interval, the coordinator ticks at the fastest one.
+        self._schedule = DeviceSchedule(DEFAULT_CLOUD_POLL_INTERVAL)
+        self._index = {}
+        self._tier_clock = TierClock()
+        self._regions = {}
+        # did -> rounds in a row its request failed
+        self._failures = Counter()
+        self._offline = set()
+        self.data = EMPTY_SNAPSHOT
 
-    def add_fixed_by_mapping(self, cloudconfig, mapping):
+    def register_mapping(self, cloudconfig, mapping, poll_interval = None, poll_tiers = None):
+        """Add the properties of an entity to the batched read. Every
+           (did, siid, piid) is requested once however many entities use it.
+           Returns the function that takes the registration back."""
         did = cloudconfig.get("did")
-        for value in mapping.values():
-            if 'aiid' not in value:
-                self._fixed_list.append({**{'did':did},**value})
+        self._regions[did] = cloudconfig.get("server_location")
+        poll_tiers = poll_tiers or {}
+        registered = []
+        for key, value in mapping.items():
+            if 'aiid' in value or 'piid' not in value:
+                continue
+            k = (did, value['siid'], value['piid'])
+            tier = poll_tiers.get(key, POLL_TIER_NORMAL)
+            self._registry.setdefault(k, Counter())[tier] += 1
+            registered.append((k, tier))
+        if poll_interval:
+            self._schedule.set_bounds(did, poll_interval)
+        self._tier_clock.reset(did)
+        self._schedule.snap(did)
+
+        @callback
+        def unregister():
+            for k, tier in registered:
+                if (refs := self._registry.get(k)) is None:
+                    continue
+                refs[tier] -= 1
+                if refs[tier] <= 0:
+                    del refs[tier]
+                if not refs:
+                    del self._registry[k]
+            registered.clear()
+
+        return unregister
+
+    def _tier_of(self, p):
+        refs = self._registry.get((p['did'], p.get('siid'), p.get('piid')))
+        return next((t for t in TIER_ORDER if refs and refs.get(t)), POLL_TIER_NORMAL)
+
+    def note_activity(self, did):
+        """The device was just controlled, poll it fast again."""
+        self._schedule.snap(did)
 
+    def device_available(self, did) -> bool:
+        """False if the cloud reports the device offline, or reading it
+           failed more than CLOUD_FAIL_TOLERANCE rounds in a row."""
+        return did not in self._offline and self._failures[did] <= CLOUD_FAIL_TOLERANCE
+
+    def _record_failures(self, dids):
+        for did in dids:
+            self._failures[did] += 1
+
+
+    async def _async_get_batch(self, server, params, window):
+        data2 = json.dumps({'datasource': 1, 'params': params}, separators=(',', ':'))
+        async with window:
+            a = await self._cloud_instance.get_props(data2, server)
+        if not a or a.get('code') != 0:
+            raise UpdateFailed(f"Failed to get properties from cloud ({server or 'default server'}): {a}")
+        return a['result']
 
     async def _async_update_data(self):
         """ 覆盖定期执行的方法 """
         # _LOGGER.info(f"{self._name} is updating from cloud.")
-        data1 = {}
-        data1['datasource'] = 1
-        data1['params'] = self._fixed_list + self._waiting_list
-        data2 = json.dumps(data1,separators=(',', ':'))
-
-        a = await self._cloud_instance.get_props(data2)
-
-        # dict1 = {}
-        # statedict = {}
-        if a:
-            # self._available = True
-            result = a['result']
-            results = {}
-            for item in result:
-                if item['did'] not in results:
-                    results[item['did']] = [item]
-                else:
-                    results[item['did']].append(item)
-            self._waiting_list = []
-            return results
-
-class MiotEventCoordinator(DataUpdateCoordinator):
-    def __init__(self, hass, cloud: MiCloud, cloud_config, item):
+        live = [{'did': did, 'siid': siid, 'piid': piid} for did, siid, piid in self._registry]
+        due = {p['did'] for p in live if self._schedule.is_due(p['did'])}
+        slow_due = {did for did in due if self._tier_clock.slow_due(did)}
+        params = [
+            p for p in live if p['did'] in due and self._tier_of(p) != POLL_TIER_NONE and
+                (p['did'] in slow_due or self._tier_of(p) != POLL_TIER_SLOW)
+        ]
+        if not params:
+            return self._snapshot({}, set(), set())
+
+        # 不同服务器的设备要分开请求
+        by_region = {}
+        for p in params:
+            by_region.setdefault(self._regions.get(p['did']), []).append(p)
+        window = asyncio.Semaphore(CLOUD_BATCH_CONCURRENCY)
+        batches = [
+            (server, batch)
+            for server, region_params in by_region.items()
+            for batch in split_batches(region_params)
+        ]
+        replies = await asyncio.gather(
+            *[self._async_get_batch(server, batch, window) for server, batch in batches],
+            return_exceptions=True
+        )
+        errors = [r for r in replies if isinstance(r, Exception)]
+        failed = {
+            p['did'] for (_, batch), reply in zip(batches, replies)
+            if isinstance(reply, Exception) for p in batch
+        }
+        if len(errors) == len(replies):
+            self._record_failures(failed)
+            if isinstance(errors[0], UpdateFailed):
+                raise errors[0]
+            raise UpdateFailed(errors[0]) from errors[0]
+        for ex in errors:
+            _LOGGER.warning("Part of the cloud update of %s failed: %s", self.name, ex)
+
+        now = time.time()
+        changed = {}
+        answered = {}
+        for reply in replies:
+            if isinstance(reply, Exception):
+                continue
+            for item in reply:
+                did = item['did']
+                k = (did, item.get('siid'), item.get('piid'))
+                answered.setdefault(did, []).append((k[1:], item.get('code')))
+                prop = CloudProperty(item.get('code'), item.get('value'), now)
+                last = self._index.get(k)
+                if last is None or (last.code, last.value) != (prop.code, prop.value):
+                    changed.setdefault(did, set()).add(k[1:])
+                self._index[k] = prop
+        for did, items in answered.items():
+            self._schedule.record(did, did in changed)
+            if any(self._tier_of({'did': did, 'siid': k[0], 'piid': k[1]}) == POLL_TIER_FAST
+                   for k, _ in items):
+                self._schedule.get(did).snap()
+            if did in slow_due:
+                self._tier_clock.slow_done(did)
+        offline = {did for did, items in answered.items() if all(code == -704042011 for _, code in items)}
+        failed -= answered.keys()
+        self._record_failures(failed)
+        for did in answered:
+            self._failures.pop(did, None)
+        self._offline = (self._offline - answered.keys()) | offline
+        return self._snapshot(changed, answered, offline, failed)
+
+    def _snapshot(self, changed, answered, offline, failed=frozenset()) -> CloudSnapshot:
+        # Values of properties nobody registers any more are dropped.
+        for k in [k for k in self._index if k not in self._registry]:
+            del self._index[k]
+        return CloudSnapshot(
+            index=MappingProxyType(dict(self._index)),
+            changed=MappingProxyType({did: frozenset(keys) for did, keys in changed.items()}),
+            answered=frozenset(answered),
+            offline=frozenset(offline),
+            failed=frozenset(failed),
+        )
+
+class MiotLocalCoordinator(PhasedCoordinator):
+    """Manages polling for state changes from a local device.
+       One for each host, shared by every entity of that host."""
+
+    def __init__(self, hass, device: MiotDevice, model: str = None,
+                 max_properties: int = None, pipeline_window: int = 1):
         """Initialize the data update coordinator."""
         DataUpdateCoordinator.__init__(
             self,
             hass,
             _LOGGER,
-            name=f"{DOMAIN}-{cloud.auth['user_id']}-event-{item[0]}",
-            update_interval=timedelta(seconds=6),
+            name=f"{DOMAIN}-{device.ip}",
+            update_interval=timedelta(seconds=DEFAULT_LOCAL_POLL_INTERVAL[0]),
+            request_refresh_debouncer=Debouncer(
+                hass, _LOGGER, cooldown=1, immediate=True
+            ),
         )
-        self._cloud_instance = cloud
-        self._cloud = cloud_config
-        # self._mapping = mapping
-        self._item = item
-        self._error_count = 0
-        self._results = {}
+        self._phase = phase_of(f"{device.ip}-{device.token}")
+        self._device = device
+        self._model = model
+        # Set by hand in params. None means the probed value is used.
+        self._max_properties = max_properties
+        self._pipeline_window = pipeline_window
+        self._mappings = {}
+        self._interval = AdaptiveInterval(*DEFAULT_LOCAL_POLL_INTERVAL)
+        self._poll_interval = None
+        # Scan interval of the platform of every entity, the shortest one is the lower bound.
+        self._scan_intervals = {}
+        # Entities that want a fixed fast interval for now, e.g. a moving cover.
+        self._holds = {}
+        self._tier_clock = TierClock()
+        # Shared by all entities of this host.
+        self._breaker = CircuitBreaker()
+
+    def add_mapping(self, owner, mapping, max_properties = None,
+                    pipeline_window = 1, poll_interval = None, poll_tiers = None):
+        """Register the properties of an entity. Registering again replaces
+           the previous ones, so reloaded entities do not pile up."""
+        poll_tiers = poll_tiers or {}
+        self._mappings[owner] = {
+            (v['siid'], v['piid']): poll_tiers.get(k, POLL_TIER_NORMAL)
+            for k, v in mapping.items() if 'aiid' not in v and 'piid' in v
+        }
+        # Read the slow ones of the new entity right away.
+        self._tier_clock.reset()
+        if max_properties is not None:
+            self._max_properties = min(self._max_properties or max_properties, max_properties)
+        self._pipeline_window = min(self._pipeline_window, pipeline_window)
+        if poll_interval:
+            if self._poll_interval:
+                poll_interval = (min(self._poll_interval[0], poll_interval[0]),
+                                 min(self._poll_interval[1], poll_interval[1]))
+            self._poll_interval = tuple(poll_interval)
+            self._update_bounds()
+
+    def remove_mapping(self, owner):
+        self._mappings.pop(owner, None)
+        self._holds.pop(owner, None)
+        if self._scan_intervals.pop(owner, None) is not None:
+            self._update_bounds()
+
+    @property
+    def in_use(self) -> bool:
+        return bool(self._mappings)
+
+    def close(self):
+        self._device.close()
+
+    def set_scan_interval(self, owner, seconds: float):
+        """Poll at least as fast as the platform of this entity asks for,
+           unless poll_interval was set by hand."""
+        self._scan_intervals[owner] = seconds
+        self._update_bounds()
+
+    def hold_interval(self, owner, seconds: float = None):
+        """Poll every `seconds` for this entity until it is called again
+           with None."""
+        if seconds:
+            if self._holds.get(owner) == seconds:
+                return
+            self._holds[owner] = seconds
+        elif self._holds.pop(owner, None) is None:
+            return
+        self.update_interval = self._next_interval()
+        if self._listeners:
+            self._schedule_refresh()
+
+    def _update_bounds(self):
+        low, high = self._poll_interval or DEFAULT_LOCAL_POLL_INTERVAL
+        if not self._poll_interval and self._scan_intervals:
+            low = min(low, *self._scan_intervals.values())
+        self._interval.set_bounds(low, high)
+        self.update_interval = self._next_interval()
+
+    def _next_interval(self) -> timedelta:
+        return timedelta(seconds=min([self._interval.interval, *self._holds.values()]))
+
+    @property
+    def unreachable(self) -> bool:
+        return self._breaker.is_open
+
+    def note_activity(self):
+        """The device was just controlled, poll it fast again."""
+        self._interval.snap()
+        self.update_interval = self._next_interval()
+        if self._listeners:
+            self._schedule_refresh()
+
+    @property
+    def max_properties(self) -> int:
+        if self._max_properties is not None:
+            return self._max_properties
+        if probed := self.hass.data[DOMAIN]['max_properties'].get(self._model):
+            return probed['max_properties']
+        return DEFAULT_MAX_PROPERTIES
+
+    def _need_probe(self, properties) -> bool:
+        if self._max_properties is not None or not self._model:
+            return False
+        probed = self.hass.data[DOMAIN]['max_properties'].get(self._model)
+        if probed is None:
+            return True
+        if time.time() - probed.get('probed_at', 0) > MAX_PROPERTIES_PROBE_TTL:
+            return True
+        # Only a lower bound was found, and now there are more properties to read.
+        return not probed['limit_found'] and \
+            probed['max_properties'] < min(len(properties), MAX_PROPERTIES_PROBE_LIMIT)
+
+    async def _async_probe_max_properties(self, properties):
+        """Grow the batch size until the device errors or times out, then
+           save the largest accepted size for this model."""
+        async def accepts(n) -> bool:
+            for _ in range(MAX_PROPERTIES_PROBE_ATTEMPTS):
+                try:
+                    values = await self._device.async_send("get_properties", properties[:n], retry_count=0)
+                except DeviceError as ex:
+                    _LOGGER.debug("%s refused %s properties at once: %s", self._model, n, ex)
+                    return False
+                except DeviceException as ex:
+                    # No reply may just be a lost packet, try the same size again.
+                    _LOGGER.debug("%s did not answer %s properties at once: %s", self._model, n, ex)
+                    continue
+                return isinstance(values, list) and len(values) == n
+            return False
+
+        limit = min(len(properties), MAX_PROPERTIES_PROBE_LIMIT)
+        good, bad, n = 0, None, 1
+        while True:
+            if await accepts(n):
+                good = n
+                if n >= limit:
+                    break
+                n = min(n * 2, limit)
+            else:
+                bad = n
+                break
+        if good == 0:
+            # Not reachable right now, try again next time.
+            return
+        while bad is not None and bad - good > 1:
+            mid = (good + bad) // 2
+            if await accepts(mid):
+                good = mid
+            else:
+                bad = mid
+
+        _LOGGER.info("%s accepts %s properties per request.", self._model, good)
+        self.hass.data[DOMAIN]['max_properties'][self._model] = {
+            'max_properties': good,
+            'limit_found': bad is not None,
+            'probed_at': time.time(),
+        }
+        self.hass.data[DOMAIN]['max_properties_store'].async_delay_save(
+            lambda: self.hass.data[DOMAIN]['max_properties'], 10
+        )
+
+    @property
+    def tiers(self) -> dict:
+        """Poll tier of every registered property, the fastest one wins."""
+        tiers = {}
+        for mapping in self._mappings.values():
+            for k, tier in mapping.items():
+                tiers[k] = faster_tier(tiers.get(k, tier), tier)
+        return tiers
+
+    @property
+    def properties(self) -> list:
+        """Union of all registered properties, each requested only once."""
+        return [
+            {'did': f"{siid}-{piid}", 'siid': siid, 'piid': piid}
+            for (siid, piid), tier in sorted(self.tiers.items()) if tier != POLL_TIER_NONE
+        ]
+
+    def get_response_for_mapping(self, mapping) -> list:
+        """Rebuild a get_properties_for_mapping style response for an entity."""
+        if not self.data:
+            return []
+        response = []
+        for key, value in mapping.items():
+            if 'aiid' in value or 'piid' not in value:
+                continue
+            if (r := self.data.get((value['siid'], value['piid']))) is not None:
+                response.append({**r, 'did': key})
+        return response
 
     async def _async_update_data(self):
+        """Read the union of all mapped properties in one pass. The slow tier
+           is only read every few minutes, its last values are kept."""
+        tiers = self.tiers
+        all_properties = self.properties
+        if not all_properties:
+            return {}
+        if not self._breaker.allow():
+            raise UpdateFailed(
+                f"{self._device.ip} is unreachable, next probe in {self._breaker.retry_in():.0f} s"
+            )
+        slow_due = self._tier_clock.slow_due()
+        properties = [
+            p for p in all_properties
+            if slow_due or tiers[(p['siid'], p['piid'])] != POLL_TIER_SLOW
+        ]
+        try:
+            if self._need_probe(all_properties):
+                await self._async_probe_max_properties(all_properties)
+            response = await self._device.async_get_properties(
+                properties, property_getter="get_properties",
+                max_properties=self.max_properties, pipeline_window=self._pipeline_window
+            )
+        except (DeviceException, OSError) as ex:
+            self._breaker.record_failure()
+            if self._breaker.is_open:
+                _LOGGER.debug("%s failed %s times, next probe in %s s",
+                              self._device.ip, self._breaker.failures, self._breaker.backoff)
+                self.update_interval = timedelta(seconds=self._breaker.backoff)
+            raise UpdateFailed(ex) from ex
+        if self._breaker.is_open:
+            _LOGGER.info("%s is reachable again.", self._device.ip)
+        self._breaker.record_success()
+        if slow_due:
+            self._tier_clock.slow_done()
+
+        props_by_did = {p['did']: (p['siid'], p['piid']) for p in properties}
+        results = {k: v for k, v in (self.data or {}).items() if k in tiers}
+        changed = False
+        for item in response:
+            if (k := props_by_did.get(item.get('did'))) is not None:
+                if k not in results or results[k].get('value') != item.get('value'):
+                    changed = True
+                results[k] = item
+
+        self._interval.record(changed)
+        if POLL_TIER_FAST in tiers.values():
+            self._interval.snap()
+        self.update_interval = self._next_interval()
+        return results
+
+class MiotEventPoller(PhasedCoordinator):
+    """Polls the event history of all event based sensors of one account.
+
+    Each (did, key, type) has a time cursor, so only records from that
+    time on are fetched. A round polls as many of them as the account's
+    history rate allows, the longest waiting first, so a large account is
+    spread over several rounds. Listeners are only called when their key
+    got new records.
+    """
+    def __init__(self, hass, cloud: MiCloud):
+        """Initialize the data update coordinator."""
+        DataUpdateCoordinator.__init__(
+            self,
+            hass,
+            _LOGGER,
+            name=f"{DOMAIN}-{cloud.auth['user_id']}-events",
+            update_interval=timedelta(seconds=EVENT_POLL_INTERVAL),
+        )
+        self._phase = phase_of(f"{cloud.auth['user_id']}-events")
+        self._cloud_instance = cloud
+        self._subscriptions = {}
+        self._cursors = {}
+        self._last_poll = {}
+        self._fresh = set()
+        self.data = {}
+
+    @callback
+    def async_add_event_listener(self, cloud_config, item, update_callback):
+        """item 形如: ('motion', {'key': 1, 'type': 'prop'})"""
+        key = (cloud_config.get('did'), item[1]['key'], item[1]['type'])
+        sub = self._subscriptions.setdefault(
+            key, {'server': cloud_config.get('server_location'), 'count': 0})
+        sub['count'] += 1
+
+        @callback
+        def on_update():
+            if key in self._fresh:
+                update_callback()
+
+        remove_listener = self.async_add_listener(on_update)
+
+        @callback
+        def remove():
+            remove_listener()
+            sub['count'] -= 1
+            if sub['count'] <= 0:
+                for d in (self._subscriptions, self._cursors, self._last_poll, self.data):
+                    d.pop(key, None)
+        return remove
+
+    def events(self, cloud_config, item) -> list:
+        """The records of an event from the latest rounds, newest first."""
+        return self.data.get((cloud_config.get('did'), item[1]['key'], item[1]['type'])) or []
+
+    async def _async_fetch(self, key) -> bool:
+        did, event_key, event_type = key
+        cursor = self._cursors.get(key)
         result = await self._cloud_instance.get_user_device_data(
-            self._cloud.get("did"),
-            self._item[1]['key'],
-            self._item[1]['type'],
-            self._cloud.get("server_location"),
+            did, event_key, event_type, self._subscriptions[key]['server'],
+            limit=EVENT_HISTORY if cursor is None else EVENT_FETCH_LIMIT,
+            time_start=cursor or 0,
         )
+        self._last_poll[key] = time.monotonic()
         if result is None:
-            return None
+            return False
         if result['code'] != 0:
             _LOGGER.error(result)
-            return result
-        else:
-            result2 = [(datetime.fromtimestamp(item['time']).isoformat(sep=' '), item['value']) for item in result['result']]
-        # self._results[k] = result2
-            return result2
\ No newline at end of file
+            return False
+        items = result.get('result') or []
+        if not items:
+            return True
+        # The cursor second is fetched again, records of it may be known already.
+        self._cursors[key] = max(item['time'] for item in items)
+        known = set(self.data.get(key) or [])
+        new = [
+            (datetime.fromtimestamp(item['time']).isoformat(sep=' '), item['value'])
+            for item in sorted(items, key=lambda item: item['time'], reverse=True)
+        ]
+        new = [r for r in new if r not in known]
+        if new:
+            # Sensors keep their own history, this only has to cover one round.
+            self.data[key] = (new + list(self.data.get(key) or []))[:EVENT_FETCH_LIMIT]
+            self._fresh.add(key)
+        return True
+
+    async def _async_update_data(self):
+        self._fresh = set()
+        rate = self._cloud_instance.rate_limiter.rate('history')
+        budget = max(1, int(rate * EVENT_POLL_INTERVAL))
+        keys = sorted(self._subscriptions, key=lambda k: self._last_poll.get(k, 0))[:budget]
+        if not keys:
+            return self.data
+        results = await asyncio.gather(*[self._async_fetch(k) for k in keys])
+        if not any(results):
+            raise UpdateFailed(f"Failed to get events of {len(keys)} devices from cloud")
+        return self.data
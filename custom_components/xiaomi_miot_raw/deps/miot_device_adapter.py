@@ -4,6 +4,7 @@ from dataclasses import dataclass
 import logging
 from .const import MAP
 from .special_devices import SPECIAL_DEVICES
+from .poll_scheduler import POLL_TIER_NONE, POLL_TIER_SLOW
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -59,6 +60,19 @@ ACCESS_NOTIFY = 0b100
 CUSTOM_SERVICES = {'custom_service', 'private_service', 'dm_service'}
 SUPPORTED = {vv for v in MAP.values() for vv in v}.union(CUSTOM_SERVICES)
 
+# 这些基本不变的属性不需要每次都读
+SLOW_SERVICES = ('filter', 'battery', 'device_information')
+SLOW_PROPERTIES = ('countdown', 'filter_', 'firmware', 'version', 'life')
+
+def get_poll_tier(service:str, p) -> str:
+    if 'read' not in p.access:
+        return POLL_TIER_NONE
+    if service and service.startswith(SLOW_SERVICES):
+        return POLL_TIER_SLOW
+    if any(s in p.newid for s in SLOW_PROPERTIES):
+        return POLL_TIER_SLOW
+    return None
+
 def get_type_by_mitype(mitype:str):
     if mitype == "fan_control":
         return "fan_control"
@@ -212,6 +226,7 @@ class MiotAdapter:
             return None
 
     def get_params(self, propdict: dict = {}, devtype = ""):
+        service = devtype
         devtype = get_type_by_mitype(devtype)
         if not propdict:
             return None
@@ -426,6 +441,8 @@ class MiotAdapter:
                     r['value_list'] = dict([(a['description'], a['value']) for a in v.vlist])
                 elif v.vrange:
                     r['value_range'] = v.vrange
+                if tier := get_poll_tier(service, v):
+                    r['poll_tier'] = tier
                 ret[k] = r
 
             return ret
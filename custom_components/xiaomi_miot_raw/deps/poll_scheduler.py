@@ -0,0 +1,170 @@
+import hashlib
+import random
+import time
+
+DEFAULT_LOCAL_POLL_INTERVAL = (10, 60)
+DEFAULT_CLOUD_POLL_INTERVAL = (6, 60)
+
+POLL_TIER_FAST = 'fast'
+POLL_TIER_NORMAL = 'normal'
+POLL_TIER_SLOW = 'slow'
+# not read at all, e.g. write-only properties
+POLL_TIER_NONE = 'none'
+SLOW_TIER_INTERVAL = 300
+
+BREAKER_THRESHOLD = 3
+BREAKER_BASE_BACKOFF = 30
+BREAKER_MAX_BACKOFF = 600
+
+# +- share of the interval added to every scheduled poll
+JITTER_RATIO = 0.05
+
+
+def phase_of(key: str) -> float:
+    """Stable position in [0, 1) of key within any interval, the same after every restart."""
+    digest = hashlib.md5(str(key).encode()).digest()
+    return int.from_bytes(digest[:4], "big") / 2 ** 32
+
+
+def phased_delay(phase: float, interval: float, now: float = None,
+                 jitter: float = JITTER_RATIO) -> float:
+    """Seconds until the next slot of this phase, between half and one and
+    a half intervals away so that the rhythm is kept, plus some jitter."""
+    now = now if now is not None else time.time()
+    delay = (phase * interval - now) % interval
+    if delay < interval / 2:
+        delay += interval
+    return delay + random.uniform(-jitter, jitter) * interval
+
+
+class AdaptiveInterval:
+    """Polling interval of one device, driven by how often it changes.
+
+    `change_rate` is an EWMA of "the last poll saw a change". A device that
+    changes on every poll stays at the lower bound; one that rarely changes
+    drifts towards the upper bound. Activity such as a write snaps it back.
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, alpha: float = 0.2):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self._alpha = alpha
+        self.change_rate = 1.0
+        self.interval = min_interval
+
+    def set_bounds(self, min_interval: float, max_interval: float):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self._update_interval()
+
+    def record(self, changed: bool):
+        """Feed the result of one poll."""
+        self.change_rate = self._alpha * (1.0 if changed else 0.0) + (1 - self._alpha) * self.change_rate
+        self._update_interval()
+
+    def snap(self):
+        """Back to fast polling, e.g. after a write."""
+        self.change_rate = 1.0
+        self._update_interval()
+
+    def _update_interval(self):
+        if self.change_rate * self.max_interval <= self.min_interval:
+            self.interval = self.max_interval
+        else:
+            self.interval = self.min_interval / self.change_rate
+
+
+class DeviceSchedule:
+    """When each device of a shared poller is due next."""
+
+    def __init__(self, bounds: tuple = DEFAULT_CLOUD_POLL_INTERVAL):
+        self._bounds = bounds
+        self._intervals = {}
+        self._next_poll = {}
+
+    def get(self, key) -> AdaptiveInterval:
+        if key not in self._intervals:
+            self._intervals[key] = AdaptiveInterval(*self._bounds)
+        return self._intervals[key]
+
+    def set_bounds(self, key, bounds: tuple):
+        self.get(key).set_bounds(*bounds)
+
+    def is_due(self, key, now: float = None) -> bool:
+        now = now if now is not None else time.monotonic()
+        # Half a second of slack, so the tick that is just a bit early counts.
+        return self._next_poll.get(key, 0) <= now + 0.5
+
+    def record(self, key, changed: bool, now: float = None):
+        now = now if now is not None else time.monotonic()
+        interval = self.get(key)
+        interval.record(changed)
+        self._next_poll[key] = now + interval.interval * (1 + random.uniform(-JITTER_RATIO, JITTER_RATIO))
+
+    def snap(self, key):
+        self.get(key).snap()
+        self._next_poll[key] = 0
+
+
+class TierClock:
+    """Decides whether the slow tier of a key is read in this cycle."""
+
+    def __init__(self, slow_interval: float = SLOW_TIER_INTERVAL):
+        self._slow_interval = slow_interval
+        self._last_slow = {}
+
+    def slow_due(self, key=None, now: float = None) -> bool:
+        now = now if now is not None else time.monotonic()
+        return now - self._last_slow.get(key, -self._slow_interval) >= self._slow_interval
+
+    def slow_done(self, key=None, now: float = None):
+        self._last_slow[key] = now if now is not None else time.monotonic()
+
+    def reset(self, key=None):
+        self._last_slow.pop(key, None)
+
+
+class CircuitBreaker:
+    """Stops polling a host that keeps failing.
+
+    After `threshold` failures in a row the breaker opens and only lets a
+    probe through when its backoff ran out. The backoff doubles with every
+    failed probe up to `max_backoff`, one success closes the breaker.
+    """
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD,
+                 base_backoff: float = BREAKER_BASE_BACKOFF,
+                 max_backoff: float = BREAKER_MAX_BACKOFF):
+        self.threshold = threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self._open_until = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self.failures >= self.threshold
+
+    @property
+    def backoff(self) -> float:
+        if not self.is_open:
+            return 0
+        return min(self.base_backoff * 2 ** (self.failures - self.threshold), self.max_backoff)
+
+    def allow(self, now: float = None) -> bool:
+        now = now if now is not None else time.monotonic()
+        return not self.is_open or now >= self._open_until
+
+    def retry_in(self, now: float = None) -> float:
+        now = now if now is not None else time.monotonic()
+        return max(0, self._open_until - now)
+
+    def record_failure(self, now: float = None):
+        now = now if now is not None else time.monotonic()
+        self.failures += 1
+        if self.is_open:
+            self._open_until = now + self.backoff
+
+    def record_success(self):
+        self.failures = 0
+        self._open_until = 0
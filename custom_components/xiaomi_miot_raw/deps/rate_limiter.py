@@ -0,0 +1,130 @@
+import asyncio
+import time
+
+# requests per second, per account
+DEFAULT_RATE_LIMITS = {
+    'read': 5,
+    'write': 5,
+    'history': 1,
+}
+# shared by all buckets of an account
+DEFAULT_TOTAL_RATE_LIMIT = 8
+# How many requests a bucket may send at once after being idle, in seconds of rate.
+BURST_SECONDS = 2
+
+# Lower goes first: a write waits for no poll.
+PRIORITIES = {
+    'write': 0,
+    'read': 1,
+    'history': 2,
+}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or max(1, rate * BURST_SECONDS)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def take(self):
+        self._tokens -= 1
+
+    def wait_time(self, now: float = None) -> float:
+        self._refill(now if now is not None else time.monotonic())
+        return max(0, (1 - self._tokens) / self.rate)
+
+
+class CloudRateLimiter:
+    """Token buckets for the cloud requests of one account.
+
+    Every class of requests (reads, writes and actions, history queries)
+    has its own bucket, and all of them share the account's total bucket.
+    Waiting requests are served by priority, then in order of arrival, so
+    a write is not stuck behind a queue of polls for the total budget.
+    """
+
+    def __init__(self, limits: dict = None, total: float = DEFAULT_TOTAL_RATE_LIMIT):
+        self._buckets = {}
+        self._total = None
+        self._waiters = []
+        self._seq = 0
+        self._timer = None
+        self.requests = {}
+        self.waits = {}
+        self.wait_time = {}
+        self.set_limits(limits, total)
+
+    def set_limits(self, limits: dict = None, total: float = DEFAULT_TOTAL_RATE_LIMIT):
+        limits = {**DEFAULT_RATE_LIMITS, **(limits or {})}
+        total = limits.pop('total', total)
+        self._buckets = {k: TokenBucket(v) for k, v in limits.items()}
+        self._total = TokenBucket(total)
+
+    def rate(self, kind: str) -> float:
+        return self._buckets[kind].rate
+
+    def _wait_for(self, kind, now) -> float:
+        return max(self._buckets[kind].wait_time(now), self._total.wait_time(now))
+
+    def _try_take(self, kind, now) -> bool:
+        if self._wait_for(kind, now) > 0:
+            return False
+        self._buckets[kind].take()
+        self._total.take()
+        return True
+
+    def stats(self) -> dict:
+        return {
+            kind: {
+                'rate': bucket.rate,
+                'requests': self.requests.get(kind, 0),
+                'waiting': sum(1 for w in self._waiters if w[2] == kind),
+                'wait_time': round(self.wait_time.get(kind, 0), 3),
+                'avg_wait': round(self.wait_time.get(kind, 0) / self.waits[kind], 3)
+                    if self.waits.get(kind) else 0,
+            }
+            for kind, bucket in self._buckets.items()
+        }
+
+    async def acquire(self, kind: str):
+        if not self._waiters and self._try_take(kind, time.monotonic()):
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        self._waiters.append((PRIORITIES.get(kind, len(PRIORITIES)), self._seq, kind, fut))
+        self._waiters.sort(key=lambda w: w[:2])
+        start = time.monotonic()
+        self._dispatch()
+        try:
+            await fut
+        finally:
+            if not fut.done():
+                fut.cancel()
+            self._waiters = [w for w in self._waiters if w[3] is not fut]
+        self.requests[kind] = self.requests.get(kind, 0) + 1
+        self.waits[kind] = self.waits.get(kind, 0) + 1
+        self.wait_time[kind] = self.wait_time.get(kind, 0) + time.monotonic() - start
+
+    def _dispatch(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        next_wake = None
+        for _, _, kind, fut in self._waiters:
+            if fut.done():
+                continue
+            if self._try_take(kind, now):
+                fut.set_result(None)
+                continue
+            wait = self._wait_for(kind, now)
+            next_wake = wait if next_wake is None else min(next_wake, wait)
+        self._waiters = [w for w in self._waiters if not w[3].done()]
+        if next_wake is not None:
+            self._timer = asyncio.get_running_loop().call_later(next_wake, self._dispatch)
@@ -0,0 +1,40 @@
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_OPTIMISTIC_TTL = 10
+
+
+class OptimisticCache:
+    """Values we just wrote, trusted over polled ones for a while.
+
+    A poll that disagrees within the TTL is most likely older than the
+    write, so the written value is kept. A poll that agrees confirms the
+    value and ends its TTL early.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_OPTIMISTIC_TTL):
+        self.ttl = ttl
+        self._values = {}
+
+    def set(self, key, value, ttl: float = None):
+        self._values[key] = (value, time.monotonic() + (ttl if ttl is not None else self.ttl))
+
+    def keys(self):
+        """Keys still tracked, including expired ones not applied yet."""
+        return self._values.keys()
+
+    def apply(self, statedict: dict) -> dict:
+        now = time.monotonic()
+        for key, (value, expires) in list(self._values.items()):
+            if expires <= now:
+                del self._values[key]
+            elif key not in statedict:
+                continue
+            elif statedict[key] == value:
+                del self._values[key]
+            else:
+                _LOGGER.debug("Ignoring stale %s=%s, %s was written", key, statedict[key], value)
+                statedict[key] = value
+        return statedict
@@ -0,0 +1,82 @@
+import asyncio
+import json
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_WRITE_BATCH_WINDOW = 0.02
+WRITE_BATCH_MAX_PROPERTIES = 100
+
+
+class WriteBatcher:
+    """Merges cloud property writes of one account into few requests.
+
+    Writes arriving within `window` seconds of the first one are sent
+    together, one request per region. The same did/siid/piid written twice
+    in a window is sent once with the last value. Every caller gets back a
+    response shaped like a plain set_props one, holding only the result
+    items of the properties it wrote.
+    """
+
+    def __init__(self, send):
+        # send(body: str, server) -> response dict of /miotspec/prop/set
+        self._send = send
+        self._pending = {}
+        self._timers = {}
+        # keep the send tasks referenced until they are done
+        self._tasks = set()
+        self.batches = 0
+        self.merged_writes = 0
+
+    async def set_props(self, params: list, server: str = None,
+                        window: float = DEFAULT_WRITE_BATCH_WINDOW):
+        if not params:
+            return {'code': 0, 'result': []}
+        loop = asyncio.get_running_loop()
+        batch = self._pending.setdefault(server, {})
+        futures = []
+        for item in params:
+            key = (str(item['did']), item['siid'], item['piid'])
+            fut = loop.create_future()
+            if key in batch:
+                self.merged_writes += 1
+                batch[key] = (item, batch[key][1] + [fut])
+            else:
+                batch[key] = (item, [fut])
+            futures.append(fut)
+        if server not in self._timers:
+            self._timers[server] = loop.call_later(window, self._flush, server)
+
+        answers = await asyncio.gather(*futures)
+        if any(resp is None for resp, _ in answers):
+            return None
+        if (resp := answers[0][0]).get('code') != 0:
+            return resp
+        return {**resp, 'result': [r for _, r in answers if r is not None]}
+
+    def _flush(self, server):
+        self._timers.pop(server, None)
+        batch = self._pending.pop(server, {})
+        items = list(batch.items())
+        for i in range(0, len(items), WRITE_BATCH_MAX_PROPERTIES):
+            self.batches += 1
+            task = asyncio.ensure_future(
+                self._send_batch(server, dict(items[i:i + WRITE_BATCH_MAX_PROPERTIES])))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send_batch(self, server, batch: dict):
+        body = json.dumps({'params': [item for item, _ in batch.values()]}, separators=(',', ':'))
+        resp = None
+        try:
+            resp = await self._send(body, server)
+        except Exception:
+            _LOGGER.exception(f"Batched write to {server or 'default server'} failed")
+        results = {}
+        if resp and resp.get('code') == 0:
+            for r in resp.get('result') or []:
+                results[(str(r.get('did')), r.get('siid'), r.get('piid'))] = r
+        for key, (_, futures) in batch.items():
+            for fut in futures:
+                if not fut.done():
+                    fut.set_result((resp, results.get(key)))
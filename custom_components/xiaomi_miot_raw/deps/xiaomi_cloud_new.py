@@ -28,6 +28,7 @@
 """
 import asyncio
 import base64
+import functools
 import hashlib
 import hmac
 import json
@@ -37,14 +38,60 @@ import os
 import random
 import string
 import time
+from collections import Counter
+from dataclasses import dataclass
 
-from aiohttp import ClientSession, ClientConnectorError
+from aiohttp import ClientSession, ClientConnectionError, ClientConnectorError
+
+from .write_batcher import WriteBatcher, DEFAULT_WRITE_BATCH_WINDOW
+from .rate_limiter import CloudRateLimiter
 
 _LOGGER = logging.getLogger(__name__)
 
 SERVERS = ['cn', 'de', 'i2', 'ru', 'sg', 'us']
 UA = "Android-7.1.1-1.0.0-ONEPLUS A3010-136-%s APP/xiaomi.smarthome APPV/62830"
 
+# Successful reads are reused for this long, 0 disables the cache.
+READ_CACHE_TTL = 1
+# After a failed automatic re-login, wait this long before the next one.
+RELOGIN_BACKOFF = 300
+REQUEST_TIMEOUT = 5
+# A server's whole device list fetch, retries included.
+DEVICE_LIST_TIMEOUT = 35
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """How often a class of requests is tried, all within `deadline` seconds.
+
+    Requests that change something are only retried when the connection
+    could not be made (`retry_timeouts=False`), a timeout may mean the
+    request did arrive.
+    """
+    attempts: int = 1
+    base_delay: float = 0.5
+    max_delay: float = 4
+    deadline: float = 10
+    retry_timeouts: bool = True
+
+
+RETRY_POLICIES = {
+    'read': RetryPolicy(attempts=3),
+    'write': RetryPolicy(attempts=2, retry_timeouts=False),
+    'action': RetryPolicy(attempts=2, retry_timeouts=False),
+    'device_list': RetryPolicy(attempts=3, base_delay=1, deadline=30),
+    'history': RetryPolicy(attempts=3),
+}
+
+# request class -> token bucket of the rate limiter
+RATE_BUCKETS = {
+    'read': 'read',
+    'device_list': 'read',
+    'write': 'write',
+    'action': 'write',
+    'history': 'history',
+}
+
 
 class MiCloud:
     auth = None
@@ -54,6 +101,20 @@ class MiCloud:
     def __init__(self, session: ClientSession):
         self.session = session
         self.device_id = get_random_string(16)
+        self._inflight = {}
+        self._read_cache = {}
+        self.coalesced_reads = 0
+        # 每次写入加一，写入前发出的读取结果不再缓存
+        self._read_generation = 0
+        self.write_batcher = WriteBatcher(self.set_props)
+        self._credentials = None
+        self._on_auth_change = None
+        self._relogin = None
+        self._relogin_failed_at = None
+        self.retry_policies = dict(RETRY_POLICIES)
+        self.retries = Counter()
+        self.failed_requests = Counter()
+        self.rate_limiter = CloudRateLimiter()
 
     async def login(self, username: str, password: str):
         try:
@@ -94,6 +155,48 @@ class MiCloud:
 
         return True
 
+    def set_credentials(self, username: str, password: str, on_auth_change=None):
+        """Enables re-login when the service token expires. `on_auth_change`
+           is called with the new auth, to save it."""
+        self._credentials = (username, password)
+        self._on_auth_change = on_auth_change
+
+    async def _refresh_auth(self, expired: dict) -> bool:
+        """Log in again after `expired` was rejected. Only one login runs at
+           a time, concurrent callers wait for it."""
+        if self.auth is not expired:
+            # Someone else already refreshed it.
+            return True
+        if not self._credentials:
+            return False
+        if self._relogin is None:
+            if self._relogin_failed_at and time.monotonic() - self._relogin_failed_at < RELOGIN_BACKOFF:
+                return False
+            self._relogin = asyncio.ensure_future(self._relogin_once())
+        try:
+            return await asyncio.shield(self._relogin)
+        finally:
+            if self._relogin is not None and self._relogin.done():
+                self._relogin = None
+
+    async def _relogin_once(self) -> bool:
+        _LOGGER.info("小米账号登录信息失效，正在重新登录")
+        try:
+            result = await self.login(*self._credentials)
+        except Exception:
+            result = (-2, None)
+        if result != (0, None):
+            _LOGGER.error(f"Can't login to MiCloud again: {result}")
+            self._relogin_failed_at = time.monotonic()
+            return False
+        self._relogin_failed_at = None
+        if self._on_auth_change:
+            try:
+                self._on_auth_change(self.auth)
+            except Exception:
+                _LOGGER.exception("Can't save new MiCloud auth")
+        return True
+
     async def _login_step1(self):
         _LOGGER.debug(f"Logging in to Xiaomi Cloud (1/3)...")
         try:
@@ -135,14 +238,50 @@ class MiCloud:
         except ClientConnectorError as ex:
             return ex
 
-    async def get_total_devices(self, servers: list):
-        total = []
-        for server in servers:
-            devices = await self.get_devices(server)
-            if devices is None:
+    async def get_devices_by_region(self, servers: list) -> dict:
+        """Device lists of all servers, fetched at the same time.
+           A server that failed or timed out maps to None."""
+        async def fetch(server):
+            try:
+                return await asyncio.wait_for(self.get_devices(server), DEVICE_LIST_TIMEOUT)
+            except asyncio.TimeoutError:
+                _LOGGER.debug(f"Timeout while loading MiCloud device list from {server}")
                 return None
-            total += devices
-        return total
+
+        results = await asyncio.gather(*[fetch(s) for s in servers])
+        by_region = dict(zip(servers, results))
+        if failed := [s for s, devices in by_region.items() if devices is None]:
+            _LOGGER.warning(f"Can't load MiCloud device list from {', '.join(failed)}")
+        return by_region
+
+    async def _with_retry(self, kind: str, attempt):
+        """Run `attempt(timeout)` under the retry policy of `kind`, with
+           jittered exponential backoff between the attempts."""
+        policy = self.retry_policies[kind]
+        retry_on = (asyncio.TimeoutError, ClientConnectionError) if policy.retry_timeouts \
+            else (ClientConnectorError,)
+        deadline = None
+        n = 1
+        while True:
+            queued = time.monotonic()
+            await self.rate_limiter.acquire(RATE_BUCKETS.get(kind, 'read'))
+            # Time spent waiting for a token is not part of the budget.
+            if deadline is None:
+                deadline = time.monotonic() + policy.deadline
+            else:
+                deadline += time.monotonic() - queued
+            try:
+                return await attempt(max(0.1, min(REQUEST_TIMEOUT, deadline - time.monotonic())))
+            except (asyncio.TimeoutError, ClientConnectionError) as ex:
+                delay = min(policy.max_delay, policy.base_delay * 2 ** (n - 1)) * random.uniform(0.5, 1.5)
+                if n >= policy.attempts or not isinstance(ex, retry_on) or \
+                        time.monotonic() + delay + 1 > deadline:
+                    self.failed_requests[kind] += 1
+                    raise
+                _LOGGER.debug(f"Retrying {kind} request in {delay:.1f}s after {ex!r} ({n})")
+                self.retries[kind] += 1
+                n += 1
+                await asyncio.sleep(delay)
 
     async def get_devices(self, server: str):
         assert server in SERVERS, "Wrong server: " + server
@@ -152,14 +291,15 @@ class MiCloud:
         url = '/home/device_list'
         data = '{"getVirtualModel":false,"getHuamiDevices":0}'
 
-        nonce = gen_nonce()
-        signed_nonce = gen_signed_nonce(self.auth['ssecurity'], nonce)
-        signature = gen_signature(url, signed_nonce, nonce, data)
         try:
             loc = locale.getdefaultlocale()[0] or "en_US"
         except Exception:
             loc = "en_US"
-        try:
+
+        async def attempt(timeout):
+            nonce = gen_nonce()
+            signed_nonce = gen_signed_nonce(self.auth['ssecurity'], nonce)
+            signature = gen_signature(url, signed_nonce, nonce, data)
             r = await self.session.post(baseurl + url, cookies={
                 'userId': self.auth['user_id'],
                 'serviceToken': self.auth['service_token'],
@@ -171,41 +311,39 @@ class MiCloud:
                 'signature': signature,
                 '_nonce': nonce,
                 'data': data
-            }, timeout=5)
+            }, timeout=timeout)
+            return await r.json(content_type=None)
 
-            resp = await r.json(content_type=None)
+        try:
+            resp = await self._with_retry('device_list', attempt)
             assert resp['code'] == 0, resp
             return resp['result']['list']
 
         except asyncio.TimeoutError:
             _LOGGER.error("Timeout while loading MiCloud device list")
-        except ClientConnectorError:
+        except ClientConnectionError:
             _LOGGER.error("Failed loading MiCloud device list")
         except:
             _LOGGER.exception(f"Can't load devices list")
 
         return None
 
-    async def request_miot_api(self, api, data = None, server: str = None):
+    async def request_miot_api(self, api, data = None, server: str = None, *,
+                               kind: str = 'write', replay: bool = True):
         server = server or self.svr or 'cn'
         api_base = 'https://api.io.mi.com/app' if server == 'cn' \
             else f"https://{server}.api.io.mi.com/app"
         url = api_base+api
 
-        nonce = gen_nonce()
-        signed_nonce = gen_signed_nonce(self.auth['ssecurity'], nonce)
-        signature = gen_signature(api, signed_nonce, nonce, data)
-        headers = {
-            'content-type': "application/x-www-form-urlencoded",
-            'x-xiaomi-protocal-flag-cli': "PROTOCAL-HTTP2",
-            'connection': "Keep-Alive",
-            'accept-encoding': "gzip",
-            'cache-control': "no-cache",
-        }
-        try:
+        auth = self.auth
+
+        async def attempt(timeout):
+            nonce = gen_nonce()
+            signed_nonce = gen_signed_nonce(auth['ssecurity'], nonce)
+            signature = gen_signature(api, signed_nonce, nonce, data)
             r = await self.session.post(url, cookies={
-                'userId': self.auth['user_id'],
-                'serviceToken': self.auth['service_token'],
+                'userId': auth['user_id'],
+                'serviceToken': auth['service_token'],
             }, headers={
                 'User-Agent': UA,
                 'x-xiaomi-protocal-flag-cli': 'PROTOCAL-HTTP2'
@@ -213,11 +351,15 @@ class MiCloud:
                 'signature': signature,
                 '_nonce': nonce,
                 'data': data
-            }, timeout=5)
+            }, timeout=timeout)
+            return await r.json(content_type=None)
 
+        try:
+            resp = await self._with_retry(kind, attempt)
             self._fail_count = 0
-            resp = await r.json(content_type=None)
             if resp.get('message') == 'auth err':
+                if replay and await self._refresh_auth(auth):
+                    return await self.request_miot_api(api, data, server, kind=kind, replay=False)
                 _LOGGER.error("小米账号登录信息失效")
                 return None
             elif resp.get('code') != 0:
@@ -229,7 +371,7 @@ class MiCloud:
                 _LOGGER.info(f"Response of {api} from cloud: {resp}")
                 return resp
 
-        except (asyncio.TimeoutError, ClientConnectorError) as ex:
+        except (asyncio.TimeoutError, ClientConnectionError) as ex:
             if self._fail_count < 3 and api == "/miotspec/prop/get":
                 self._fail_count += 1
                 _LOGGER.info(f"Error while requesting MIoT api {api} : {ex} ({self._fail_count})")
@@ -238,17 +380,64 @@ class MiCloud:
         except:
             _LOGGER.exception(f"Can't request MIoT api")
 
+    async def _single_flight(self, key, factory):
+        """Share one request among concurrent identical reads.
+
+        The response is shared as well, callers must not modify it.
+        """
+        if (hit := self._read_cache.get(key)) and hit[0] > time.monotonic():
+            self.coalesced_reads += 1
+            return hit[1]
+        if (task := self._inflight.get(key)) is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(
+                functools.partial(self._flight_done, key, self._read_generation))
+        else:
+            self.coalesced_reads += 1
+        # A cancelled caller must not cancel the request of the others.
+        return await asyncio.shield(task)
+
+    def _flight_done(self, key, generation, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not READ_CACHE_TTL or task.cancelled() or task.exception():
+            return
+        if generation != self._read_generation:
+            # 请求发出后有过写入，结果可能是写入前的
+            return
+        if (resp := task.result()) and resp.get('code') == 0:
+            now = time.monotonic()
+            for k in [k for k, v in self._read_cache.items() if v[0] <= now]:
+                del self._read_cache[k]
+            self._read_cache[key] = (now + READ_CACHE_TTL, resp)
+
+    def _invalidate_reads(self):
+        """After a write, reads must go to the cloud again."""
+        self._read_generation += 1
+        self._read_cache.clear()
+        self._inflight.clear()
+
+    async def request_read_api(self, api, data = None, server: str = None, *, kind: str = 'read'):
+        """Like request_miot_api, for requests that don't change anything."""
+        server = server or self.svr or 'cn'
+        return await self._single_flight(
+            (server, api, data), lambda: self.request_miot_api(api, data, server, kind=kind))
+
     async def request_rpc(self, did, method, params: str = "", server: str = None):
         data = json.dumps({
             "id": 1,
             "method": method,
             "params": params,
         }, separators=(',', ':'))
-        return await self.request_miot_api(f'/home/rpc/{did}', data, server)
+        if method.startswith('get_'):
+            return await self.request_read_api(f'/home/rpc/{did}', data, server)
+        self._invalidate_reads()
+        return await self.request_miot_api(f'/home/rpc/{did}', data, server, kind='write')
 
     async def get_props(self, params: str = "", server: str = None, *, use_rpc = False):
         if not use_rpc:
-            return await self.request_miot_api('/miotspec/prop/get', params, server)
+            return await self.request_read_api('/miotspec/prop/get', params, server)
         else:
             p = json.loads(params).get('params')
             if p:
@@ -261,6 +450,7 @@ class MiCloud:
 
     async def set_props(self, params: str = "", server: str = None, *, use_rpc = False):
         if not use_rpc:
+            self._invalidate_reads()
             return await self.request_miot_api('/miotspec/prop/set', params, server)
         else:
             p = json.loads(params).get('params')
@@ -271,21 +461,40 @@ class MiCloud:
             _LOGGER.error("Need did!")
             return None
 
+    async def set_props_batched(self, params: list, server: str = None,
+                                window: float = DEFAULT_WRITE_BATCH_WINDOW):
+        """set_props for a list of params, merged with the writes of other
+           devices of this account issued within `window` seconds."""
+        return await self.write_batcher.set_props(params, server, window)
+
     async def call_action(self, params: str = "", server: str = None, *, use_rpc = False):
-        return await self.request_miot_api('/miotspec/action', params, server)
+        self._invalidate_reads()
+        return await self.request_miot_api('/miotspec/action', params, server, kind='action')
 
-    async def get_user_device_data(self, did: str, key, type_, server: str = None, *, limit=5):
+    async def get_user_device_data(self, did: str, key, type_, server: str = None, *, limit=5, time_start=0):
         data = {
             "uid": self.auth['user_id'],
             "did": did,
             "time_end": 9999999999,
-            "time_start": 0,
+            "time_start": time_start,
             "limit": limit,
             "key": key,
             "type": type_,
         }
         params = json.dumps(data, separators=(',', ':'))
-        return await self.request_miot_api('/user/get_user_device_data', params, server)
+        return await self.request_read_api('/user/get_user_device_data', params, server, kind='history')
+
+
+def merge_devices(by_region: dict) -> list:
+    """One list of the devices of all servers, each did only once."""
+    seen = set()
+    total = []
+    for devices in by_region.values():
+        for device in devices or []:
+            if device.get('did') not in seen:
+                seen.add(device.get('did'))
+                total.append(device)
+    return total
 
 
 def get_random_string(length: int):
@@ -168,7 +168,6 @@ class MiotFan(ToggleableMiotDevice, FanEntity):
 
         if result:
             self._oscillation = True
-            self._skip_update = True
 
     async def async_turn_on(self, speed: str = None, **kwargs) -> None:
         """旧版HA前端调风速是这个"""
@@ -192,7 +191,6 @@ class MiotFan(ToggleableMiotDevice, FanEntity):
             self._state = True
             if speed is not None:
                 self._speed = speed
-            self._skip_update = True
 
     async def async_set_speed(self, speed: str) -> None:
         """HomeKit调风速是这个，旧版speed形如“Level1”，新版是百分比"""
@@ -207,7 +205,6 @@ class MiotFan(ToggleableMiotDevice, FanEntity):
         if result:
             self._state = True
             self._mode = preset_mode
-            self._skip_update = True
 
     @property
     def current_direction(self) -> str:
@@ -314,7 +311,6 @@ class MiotSubFan(MiotSubToggleableDevice, FanEntity):
 
         if result:
             self._oscillation = True
-            self._skip_update = True
 
     async def async_set_preset_mode(self, preset_mode: str) -> None:
         """Set new preset mode."""
@@ -322,7 +318,6 @@ class MiotSubFan(MiotSubToggleableDevice, FanEntity):
         if result:
             self._state = True
             self._speed = preset_mode
-            self._skip_update = True
 
     async def async_set_percentage(self, percentage: int) -> None:
         """Set the speed percentage of the fan."""
@@ -340,7 +335,6 @@ class MiotSubFan(MiotSubToggleableDevice, FanEntity):
         if result:
             self._state = True
             self._speed = speed
-            self._skip_update = True
 
 class MiotActionList(MiotSubDevice, FanEntity):
     def __init__(self, parent_device, mapping, params, mitype):
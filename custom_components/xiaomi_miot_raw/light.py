@@ -285,7 +285,6 @@ class MiotSubLight(MiotSubToggleableDevice, LightEntity):
             self._state = False
             # self._state_attrs[f"{self._did_prefix}switch_status"] = False
             self._parent_device.schedule_update_ha_state(force_refresh=True)
-            self._skip_update = True
 
     @property
     def color_temp(self):
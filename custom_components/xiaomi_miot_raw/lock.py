@@ -124,7 +124,6 @@ class MiotPhysicalControlLock(MiotSubDevice, LockEntity):
             self._state = STATE_LOCKED
             self._state_attrs[f"{self._did_prefix}physical_controls_locked"] = True
             self._parent_device.schedule_update_ha_state(force_refresh=True)
-            self._skip_update = True
 
     async def async_unlock(self, **kwargs):
         result = await self._parent_device.set_property_new(self._did_prefix + "physical_controls_locked", False)
@@ -132,7 +131,6 @@ class MiotPhysicalControlLock(MiotSubDevice, LockEntity):
             self._state = STATE_UNLOCKED
             self._state_attrs[f"{self._did_prefix}physical_controls_locked"] = False
             self._parent_device.schedule_update_ha_state(force_refresh=True)
-            self._skip_update = True
 
     @property
     def supported_features(self):
@@ -97,7 +97,6 @@ class MiotNumberInput(NumberEntity, MiotSubDevice):
         if result:
             self._state_attrs[self._full_did] = value
             self._parent_device.schedule_update_ha_state(force_refresh=True)
-            self._skip_update = True
 
     @property
     def min_value(self):
@@ -52,13 +52,16 @@ from .deps.ble_event_parser import (
     BleButtonParser,
 )
 from collections import OrderedDict
-from .deps.miot_coordinator import MiotEventCoordinator
+from .deps.miot_coordinator import MiotEventPoller
+from .deps.event_history import EventHistory, DEFAULT_EVENT_HISTORY_SIZE
 TYPE = 'sensor'
 
 _LOGGER = logging.getLogger(__name__)
 
 DEFAULT_NAME = "Generic MIoT " + TYPE
 DATA_KEY = TYPE + '.' + DOMAIN
+# 事件传感器的属性中显示的最近事件数
+EVENT_ATTR_COUNT = 5
 
 CONF_SENSOR_PROPERTY = "sensor_property"
 CONF_SENSOR_UNIT = "sensor_unit"
@@ -215,13 +218,15 @@ class MiotEventBasedSensor(Entity):
                     self._cloud.get('ssecurity')
                 )
 
-            co = MiotEventCoordinator(hass, mc, self._cloud, self._event_item)
-            # hass.data[DOMAIN]['cloud_instance_list'].append({
-            #     "user_id": self._cloud.get('userId'),
-            #     "username": None,  # 不是从UI配置的用户，没有用户名
-            #     "cloud_instance": mc,
-            #     "coordinator": co
-            # })
+            try:
+                co = next(f['poller'] for f in hass.data[DOMAIN]['event_fetcher_list']
+                    if f['user_id'] == self._cloud.get('userId'))
+            except StopIteration:
+                co = MiotEventPoller(hass, mc)
+                hass.data[DOMAIN]['event_fetcher_list'].append({
+                    "user_id": self._cloud.get('userId'),
+                    "poller": co,
+                })
             return (mc, co)
 
 
@@ -258,7 +263,14 @@ class MiotEventBasedSensor(Entity):
         }
         self._last_notified = 0
         self._callbacks = set()
-        self.logs = []
+        self._persist_events = self._ctrl_params.get('event_history_persist', False)
+        self._history = EventHistory(
+            self._ctrl_params.get('event_history_size', DEFAULT_EVENT_HISTORY_SIZE),
+            hass.data[DOMAIN]['event_history'].get(self._unique_id) if self._persist_events else None
+        )
+        # 在属性里显示的事件数，最多为 event_history_size
+        self._event_attr_count = self._ctrl_params.get('event_history_attrs', EVENT_ATTR_COUNT)
+        self._state_attrs.update(self.last_events(self._event_attr_count))
 
         self.create_sub_entities()
 
@@ -290,9 +302,9 @@ class MiotEventBasedSensor(Entity):
     @property
     def state(self):
         """Return the state attributes of the device."""
-        if not self.coordinator.data:
+        if not (events := self._history.latest(1)):
             return None
-        return self.coordinator.data[0][0]
+        return events[0][0]
 
     @property
     def extra_state_attributes(self):
@@ -313,20 +325,32 @@ class MiotEventBasedSensor(Entity):
         """When entity is added to hass."""
         if self.coordinator:
             self.async_on_remove(
-                self.coordinator.async_add_listener(self._handle_coordinator_update)
+                self.coordinator.async_add_event_listener(
+                    self._cloud, self._event_item, self._handle_coordinator_update)
             )
 
+    @property
+    def logs(self) -> list:
+        return self._history.latest()
+
+    def last_events(self, n: int = None) -> list:
+        """The last n events as (time, value), newest first."""
+        return self._history.latest(n)
+
     @callback
     def _handle_coordinator_update(self) -> None:
-        """Handle updated data from the coordinator."""
-        statedict = self.coordinator.data
-        self.logs = statedict
+        """Handle new events from the poller."""
+        if not self._history.extend(self.coordinator.events(self._cloud, self._event_item)):
+            return
+        if self._persist_events:
+            self._hass.data[DOMAIN]['event_history'][self._unique_id] = self._history.latest()
+            self._hass.data[DOMAIN]['event_history_store'].async_delay_save(
+                lambda: self._hass.data[DOMAIN]['event_history'], 30)
 
         self._state_attrs = {
             ATTR_MODEL: self._model,
         }
-        if statedict:
-            self._state_attrs.update(statedict)
+        self._state_attrs.update(self.last_events(self._event_attr_count))
         self.async_write_ha_state()
         self.publish_updates()
 
@@ -478,8 +502,8 @@ class MiotEventBasedSubSensor(Entity):
     @property
     def state(self):
         """Return the state attributes of the device."""
-        if self._parent_sensor.logs:
-            dt = self._parent_sensor.logs[0][1]
+        if events := self._parent_sensor.last_events(1):
+            dt = events[0][1]
             return getattr(self._data_processor(dt), self._property)
         else:
             return None
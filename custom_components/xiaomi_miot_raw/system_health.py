@@ -1,4 +1,6 @@
 """Provide info to system health."""
+from collections import Counter
+
 from yarl import URL
 
 from homeassistant.components import system_health
@@ -29,8 +31,31 @@ async def system_health_info(hass):
         )
         data["accounts_count"] = len(hass.data[DOMAIN]['cloud_instance_list'])
         data["account_devices_count"] = len(hass.data[DOMAIN]['micloud_devices'])
+        clouds = [c['cloud_instance'] for c in hass.data[DOMAIN]['cloud_instance_list']]
+        retries = sum((c.retries for c in clouds), Counter())
+        failed = sum((c.failed_requests for c in clouds), Counter())
+        data["cloud_retries"] = ", ".join(f"{k} {v}" for k, v in sorted(retries.items())) or 0
+        data["cloud_failed_requests"] = ", ".join(f"{k} {v}" for k, v in sorted(failed.items())) or 0
+        data["cloud_coalesced_reads"] = sum(c.coalesced_reads for c in clouds)
+        batches = sum(c.write_batcher.batches for c in clouds)
+        merged = sum(c.write_batcher.merged_writes for c in clouds)
+        data["cloud_write_batches"] = f"{batches} ({merged} merged)"
+        usage = {}
+        for c in clouds:
+            for kind, st in c.rate_limiter.stats().items():
+                n, wait = usage.get(kind, (0, 0))
+                usage[kind] = (n + st['requests'], wait + st['wait_time'])
+        data["cloud_rate_usage"] = ", ".join(
+            f"{k} {n} ({wait / n:.2f} s)" for k, (n, wait) in usage.items() if n) or 0
 
     if hass.data[DOMAIN].get('configs'):
         data["added_devices"] = len(hass.data[DOMAIN]['configs']) - (1 if is_logged_in else 0)
 
+    if limiter := hass.data[DOMAIN].get('local_io_limiter'):
+        stats = limiter.stats()
+        data["local_io_parallelism"] = f"{stats['limit']} ({stats['per_host']} per host)"
+        data["local_io_active"] = stats['active']
+        data["local_io_queue_depth"] = f"{stats['queue_depth']} (max {stats['max_queue_depth']})"
+        data["local_io_avg_wait"] = f"{stats['avg_wait']} s"
+
     return data